@@ -1,21 +1,34 @@
 import os
+import copy
 import uuid
 import hashlib
+import hmac
 import shutil
 import subprocess
 import re
 import json
+import sqlite3
 import threading
+import time
+import asyncio
+import ctypes
+import ctypes.util
+import select
+import struct
+from collections import OrderedDict, deque
+import heapq
+import itertools
+import bisect
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any
-from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Dict, Any, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException, Depends, status
+from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException, Depends, Query, Request, Response, status
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, Field
 from jose import JWTError, jwt
@@ -51,13 +64,69 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 内存中存储任务状态（生产环境建议使用数据库）
+# --- Metrics ---
+
+class Histogram:
+    """Prometheus 直方图，按标签值分组；observe 只做一次二分查找和两次加法"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # 标签值 -> [各桶计数 (不累积)..., +Inf 桶, 总和]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self) -> List[Tuple[tuple, List[int], float]]:
+        """返回 [(标签值, 累积计数 (最后一个为 +Inf), 总和)]"""
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        return [(labels, list(itertools.accumulate(values[:-1])), values[-1]) for labels, values in series]
+
+class Counter:
+    """单调递增计数器"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+# 转码任务从开始运行到结束的墙钟时间
+JOB_WALL_SECONDS = Histogram((1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800))
+FFPROBE_SECONDS = Histogram((0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+PREVIEW_SECONDS = Histogram((0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+THUMBNAIL_SECONDS = Histogram((0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+HTTP_REQUEST_SECONDS = Histogram((0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+# 已完成转码任务读取的源文件和写出的输出文件字节数 (复用输出的任务不计入)
+JOB_BYTES_READ = Counter()
+JOB_BYTES_WRITTEN = Counter()
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.monotonic()
+    response = await call_next(request)
+    # 按路由模板 (如 /jobs/{job_id}/cancel) 统计，避免标签数量随路径参数膨胀
+    route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+    HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, request.method, route)
+    return response
+
+# 任务状态模型
 class JobStatus(BaseModel):
     id: str
     inputs: List[str]
     outputs: List[str]
     params: Dict[str, Any]
-    status: str  # running, completed, failed
+    status: str  # preparing, pending, running, completed, failed, cancelled
     command: Optional[str] = None
     error: Optional[str] = None
     input_size: Optional[int] = None
@@ -65,47 +134,724 @@ class JobStatus(BaseModel):
     compression_ratio: Optional[float] = None
     duration: Optional[float] = None
     progress: float = 0.0
+    fps: Optional[float] = None
+    speed: Optional[float] = None
+    bitrate_kbps: Optional[float] = None
+    current_size: Optional[int] = None  # 已输出的字节数
+    eta: Optional[float] = None  # 预计剩余秒数
     created_at: float = Field(default_factory=lambda: datetime.now().timestamp())
     completed_at: Optional[float] = None
+    priority: int = 0  # 数值越大越先执行
+    revision: int = 0  # 最近一次变化的修订号
+    cost_cores: Optional[int] = None  # 估算占用的 CPU 核数，同时作为自动分配的 -threads
+    cost_memory_mb: Optional[int] = None  # 估算占用的内存
+    dedup_key: Optional[str] = None  # 输入内容指纹 + 参数哈希，相同时复用已有输出
+    plan: Optional[Dict[str, Any]] = None  # 逐流的复制/编码/丢弃计划，见 plan_streams
+    target_bytes: Optional[int] = None  # target_size 模式的目标字节数
+    target_deviation: Optional[float] = None  # 实际大小相对目标的偏差 (0.02 表示大 2%)
+    reused_from: Optional[str] = None  # 输出复用自哪个任务
+    batch_id: Optional[str] = None  # 同一次提交的任务共用一个批次 ID
 
-JOBS: Dict[str, JobStatus] = {}
-JOB_PROCESSES: Dict[str, subprocess.Popen] = {}
+# preparing: 已创建、正在后台探测元数据，尚未进入调度队列
+ACTIVE_STATUSES = ("preparing", "pending", "running")
 
-# 并发控制
-MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 2))
-# 限制预览并发数为 1，防止短时间内大量启动 FFmpeg 导致内存溢出
-PREVIEW_SEMAPHORE = threading.Semaphore(1)
+# 推送合并间隔 (秒)：同一任务在一个间隔内的多次变化只推送一次
+JOB_EVENT_INTERVAL = float(os.environ.get("JOB_EVENT_INTERVAL", 0.5))
 
-# 使用足够大的线程池来容纳可能的并发任务，实际调度由逻辑控制
-executor = ThreadPoolExecutor(max_workers=20)
+class JobEventHub:
+    """任务变化记录，供推送通道按修订号增量读取
 
-def try_start_jobs():
-    """尝试启动更多任务，直到达到最大并发数"""
-    running_count = sum(1 for j in JOBS.values() if j.status == "running")
-    available_slots = MAX_CONCURRENT_JOBS - running_count
-    
-    if available_slots > 0:
-        # 查找所有 pending 的任务，按创建时间排序
-        pending_jobs = sorted(
-            [j for j in JOBS.values() if j.status == "pending"], 
-            key=lambda x: x.created_at
+    每次变化分配一个递增的修订号，同一任务只保留最新一条记录，
+    因此订阅者在一个推送间隔内对每个任务只会收到一条合并后的消息。
+    修订号以启动时间 (微秒) 为起点，服务重启后依然单调递增。
+    """
+
+    def __init__(self, history: int = 50000):
+        self._lock = threading.Lock()
+        self._revision = time.time_ns() // 1000
+        # 早于 floor 的变化已不在记录中，订阅者需要全量刷新
+        self.floor = self._revision
+        self._history = history
+        # job_id -> [修订号, 最近一次状态变化的修订号, 是否已删除]
+        self._changes: "OrderedDict[str, list]" = OrderedDict()
+
+    @property
+    def revision(self) -> int:
+        return self._revision
+
+    def _record(self, job_id: str, state: bool, removed: bool = False) -> int:
+        self._revision += 1
+        rev = self._revision
+        entry = self._changes.pop(job_id, None)
+        state_rev = entry[1] if entry is not None and not state else rev
+        self._changes[job_id] = [rev, state_rev, removed]
+        while len(self._changes) > self._history:
+            _, oldest = self._changes.popitem(last=False)
+            self.floor = oldest[0]
+        return rev
+
+    def touch(self, job: JobStatus, state: bool = True):
+        """记录任务变化；state=False 表示只有进度类字段变化"""
+        with self._lock:
+            job.revision = self._record(job.id, state)
+
+    def remove(self, job_ids: List[str]):
+        with self._lock:
+            for job_id in job_ids:
+                self._record(job_id, True, removed=True)
+
+    def changes_since(self, cursor: int) -> Tuple[int, Optional[List[Tuple[str, bool, bool]]]]:
+        """返回 (当前修订号, [(job_id, 状态是否变化, 是否已删除), ...])
+
+        cursor 早于可查询的记录时变化列表为 None，调用方需要全量刷新。
+        """
+        with self._lock:
+            if cursor < self.floor:
+                return self._revision, None
+            result = []
+            for job_id, (rev, state_rev, removed) in reversed(self._changes.items()):
+                if rev <= cursor:
+                    break
+                result.append((job_id, state_rev > cursor, removed))
+            return self._revision, result
+
+JOB_EVENTS = JobEventHub()
+
+class BatchStatus(BaseModel):
+    """一次提交 (批次) 的汇总信息，计数器由 BatchTracker 随任务变化增量维护"""
+    id: str
+    created_at: float = Field(default_factory=lambda: datetime.now().timestamp())
+    priority: int = 0
+    output_dir: Optional[str] = None
+    status: str = "pending"  # 由成员任务的状态汇总得出
+    total: int = 0
+    preparing: int = 0
+    pending: int = 0
+    running: int = 0
+    done: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    input_bytes: int = 0
+    output_bytes: int = 0
+    duration_total: float = 0.0
+    duration_done: float = 0.0  # 已结束任务的时长之和
+    progress: float = 0.0  # 按时长加权的整体进度
+    eta: Optional[float] = None
+
+# 批次中只持久化这些字段，计数器在启动时从 jobs 表重建
+BATCH_STORED_FIELDS = {"id", "created_at", "priority", "output_dir"}
+# 任务状态 -> BatchStatus 中的计数字段
+BATCH_COUNTERS = {"preparing": "preparing", "pending": "pending", "running": "running",
+                  "completed": "done", "failed": "failed", "cancelled": "cancelled"}
+
+class BatchTracker:
+    """批次计数器
+
+    每个任务记住自己上一次计入的 (批次, 状态, 输入字节, 输出字节, 时长)，
+    任务保存时只把差值加到所属批次上，查询批次不需要遍历成员任务。
+    运行中任务的进度只在内存里按批次记录。
+    另按 (created_at, id) 维护有序索引，列表只为请求的一页生成快照。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batches: Dict[str, BatchStatus] = {}
+        self._order: List[Tuple[float, str]] = []
+        self._members: Dict[str, tuple] = {}
+        # batch_id -> {job_id: 已编码的秒数}
+        self._running: Dict[str, Dict[str, float]] = {}
+        # batch_id -> (开始运行的 monotonic 时间, 当时已完成的时长)，用于估算剩余时间
+        self._started: Dict[str, Tuple[float, float]] = {}
+        # batch_id -> (没有任务运行的起始时间, 当时是否已全部结束)；这段时间不计入处理速度
+        self._idle: Dict[str, Tuple[float, bool]] = {}
+
+    def add(self, batch: BatchStatus):
+        with self._lock:
+            if batch.id not in self._batches:
+                self._batches[batch.id] = batch
+                bisect.insort(self._order, (batch.created_at, batch.id))
+
+    def _apply(self, entry: tuple, sign: int):
+        batch = self._batches.get(entry[0])
+        if batch is None:
+            return
+        status, input_size, output_size, duration = entry[1:]
+        batch.total += sign
+        counter = BATCH_COUNTERS.get(status)
+        if counter:
+            setattr(batch, counter, getattr(batch, counter) + sign)
+        batch.input_bytes += sign * (input_size or 0)
+        batch.output_bytes += sign * (output_size or 0)
+        batch.duration_total += sign * (duration or 0.0)
+        if status not in ACTIVE_STATUSES:
+            batch.duration_done += sign * (duration or 0.0)
+
+    def _record(self, job_id: str, entry: tuple):
+        old = self._members.get(job_id)
+        if old == entry:
+            return
+        if old is not None:
+            self._apply(old, -1)
+        self._members[job_id] = entry
+        self._apply(entry, 1)
+        batch_id, status = entry[0], entry[1]
+        batch = self._batches.get(batch_id)
+        if status == "running":
+            self._running.setdefault(batch_id, {}).setdefault(job_id, 0.0)
+            if batch is not None:
+                now = time.monotonic()
+                idle = self._idle.pop(batch_id, None)
+                if batch_id not in self._started or (idle is not None and idle[1]):
+                    # 首次运行，或批次结束后被重试：重新开始计时
+                    self._started[batch_id] = (now, batch.duration_done)
+                elif idle is not None:
+                    # 排在其他任务后面等待的时间不算进处理速度
+                    start, done = self._started[batch_id]
+                    self._started[batch_id] = (start + now - idle[0], done)
+        elif old is not None and old[1] == "running":
+            self._running.get(old[0], {}).pop(job_id, None)
+            if batch is not None and not batch.running and batch_id in self._started:
+                self._idle[batch_id] = (time.monotonic(), not (batch.preparing or batch.pending))
+
+    def record(self, job: JobStatus):
+        if not job.batch_id:
+            return
+        with self._lock:
+            self._record(job.id, (job.batch_id, job.status, job.input_size, job.output_size, job.duration))
+
+    def load(self, rows):
+        """启动时按 jobs 表重建计数器，rows 为 (job_id, batch_id, status, input_size, output_size, duration)"""
+        with self._lock:
+            for row in rows:
+                self._record(row[0], tuple(row[1:]))
+
+    def progress(self, job: JobStatus, seconds: float):
+        """运行中任务的进度 (已编码的秒数)"""
+        with self._lock:
+            running = self._running.get(job.batch_id)
+            if running is not None and job.id in running:
+                running[job.id] = seconds
+
+    def forget(self, job_ids: List[str]) -> List[str]:
+        """任务被删除后从批次中扣除，返回已经没有任务的批次"""
+        with self._lock:
+            touched = set()
+            for job_id in job_ids:
+                old = self._members.pop(job_id, None)
+                if old is not None:
+                    self._apply(old, -1)
+                    self._running.get(old[0], {}).pop(job_id, None)
+                    touched.add(old[0])
+            empty = [bid for bid in touched if bid in self._batches and self._batches[bid].total <= 0]
+            for bid in empty:
+                batch = self._batches.pop(bid)
+                pos = bisect.bisect_left(self._order, (batch.created_at, bid))
+                if pos < len(self._order) and self._order[pos][1] == bid:
+                    del self._order[pos]
+                self._running.pop(bid, None)
+                self._started.pop(bid, None)
+                self._idle.pop(bid, None)
+            return empty
+
+    def _snapshot(self, batch: BatchStatus) -> BatchStatus:
+        snap = batch.model_copy()
+        # 单个任务的进度不超过它自己的时长
+        running = sum(min(sec, self._members[job_id][4] or sec) for job_id, sec in self._running.get(batch.id, {}).items())
+        finished = snap.done + snap.failed + snap.cancelled
+        if snap.duration_total > 0:
+            snap.progress = min(100.0, (snap.duration_done + running) / snap.duration_total * 100)
+        elif snap.total:
+            snap.progress = finished / snap.total * 100
+        if snap.running:
+            snap.status = "running"
+        elif snap.preparing or snap.pending:
+            snap.status = "pending"
+        elif snap.failed:
+            snap.status = "failed"
+        elif snap.cancelled and not snap.done:
+            snap.status = "cancelled"
+        else:
+            snap.status = "completed"
+        # 剩余时间 = 剩余时长 / 开始运行以来的处理速度
+        started = self._started.get(batch.id)
+        if snap.status in ("running", "pending") and started:
+            idle = self._idle.get(batch.id)
+            elapsed = (idle[0] if idle else time.monotonic()) - started[0]
+            processed = snap.duration_done + running - started[1]
+            if processed > 0 and elapsed > 0:
+                snap.eta = max(0.0, (snap.duration_total - snap.duration_done - running) * elapsed / processed)
+        elif snap.status not in ("running", "pending"):
+            snap.eta = 0.0
+        return snap
+
+    def set_priority(self, batch_id: str, priority: int):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is not None:
+                batch.priority = priority
+
+    def get(self, batch_id: str) -> Optional[BatchStatus]:
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            return self._snapshot(batch) if batch is not None else None
+
+    @staticmethod
+    def _is_active(batch: BatchStatus) -> bool:
+        # 与 _snapshot 汇总出的 pending/running 状态一致
+        return bool(batch.running or batch.preparing or batch.pending)
+
+    def list(self, limit: Optional[int] = None, active: bool = False) -> List[BatchStatus]:
+        """按创建时间倒序，active 只返回未结束的批次；只为返回的批次生成快照"""
+        with self._lock:
+            result = []
+            for _, batch_id in reversed(self._order):
+                if limit is not None and len(result) >= limit:
+                    break
+                batch = self._batches[batch_id]
+                if not active or self._is_active(batch):
+                    result.append(self._snapshot(batch))
+            return result
+
+    def active_count(self) -> int:
+        with self._lock:
+            return sum(1 for b in self._batches.values() if self._is_active(b))
+
+BATCHES = BatchTracker()
+
+class JobStore:
+    """任务持久化存储 (CONFIG_DIR 下的 SQLite, WAL 模式)
+
+    未结束的任务 (pending/running) 常驻内存，转码线程直接修改这些对象，
+    状态变化时调用 save() 落盘；已结束的任务只在需要时从数据库读取。
+    """
+
+    def __init__(self, db_path: Path):
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL,
+                revision INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        # 旧版本数据库没有 revision 列
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "revision" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+        if "dedup_key" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN dedup_key TEXT")
+        if "batch_id" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
+        self._conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_revision ON jobs(revision);
+            CREATE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs(dedup_key, status);
+            CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id, status);
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+        """)
+        # 未结束任务的内存对象
+        self._active: Dict[str, JobStatus] = {}
+        # 重建批次计数器 (只读取需要的字段，不解析完整的任务 JSON)
+        for (data,) in self._conn.execute("SELECT data FROM batches"):
+            BATCHES.add(BatchStatus.model_validate_json(data))
+        BATCHES.load(self._conn.execute(
+            "SELECT id, batch_id, status, json_extract(data, '$.input_size'), json_extract(data, '$.output_size'), "
+            "json_extract(data, '$.duration') FROM jobs WHERE batch_id IS NOT NULL"
+        ))
+
+    def _write(self, job: JobStatus):
+        JOB_EVENTS.touch(job)
+        self._conn.execute(
+            "INSERT INTO jobs (id, status, created_at, data, revision, dedup_key, batch_id) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET status = excluded.status, data = excluded.data, "
+            "revision = excluded.revision, dedup_key = excluded.dedup_key",
+            (job.id, job.status, job.created_at, job.model_dump_json(), job.revision, job.dedup_key, job.batch_id),
         )
-        
-        # 启动任务
-        for job in pending_jobs[:available_slots]:
-            # 双重检查：防止在列出任务后任务被取消
-            if job.status != "pending":
+        BATCHES.record(job)
+        if job.status in ACTIVE_STATUSES:
+            self._active[job.id] = job
+        else:
+            self._active.pop(job.id, None)
+
+    def recover(self) -> int:
+        """启动时加载未结束的任务，上次关闭时仍在运行的任务重新排队，返回重新排队的数量"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM jobs WHERE status IN ('preparing', 'pending', 'running') ORDER BY created_at, rowid"
+            ).fetchall()
+            requeued = []
+            for (data,) in rows:
+                job = JobStatus.model_validate_json(data)
+                if job.status == "running":
+                    job.status = "pending"
+                    job.progress = 0.0
+                    requeued.append(job)
+                self._active[job.id] = job
+            self.save_many(requeued)
+            return len(requeued)
+
+    def save(self, job: JobStatus):
+        with self._lock:
+            self._write(job)
+
+    def save_batch(self, batch: BatchStatus):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO batches (id, created_at, data) VALUES (?, ?, ?)",
+                (batch.id, batch.created_at, batch.model_dump_json(include=BATCH_STORED_FIELDS)),
+            )
+
+    def save_many(self, jobs: List[JobStatus], batch: Optional[BatchStatus] = None):
+        """在一个事务中批量保存，batch 不为空时同时创建该批次"""
+        if not jobs:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if batch is not None:
+                    self.save_batch(batch)
+                    BATCHES.add(batch)
+                for job in jobs:
+                    self._write(job)
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, job_id: str) -> Optional[JobStatus]:
+        with self._lock:
+            job = self._active.get(job_id)
+            if job is not None:
+                return job
+            row = self._conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return JobStatus.model_validate_json(row[0]) if row else None
+
+    def find_completed(self, dedup_key: str, exclude_id: Optional[str] = None) -> Optional[JobStatus]:
+        """查找相同指纹、输出文件仍完整存在的已完成任务 (最新的优先)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, data FROM jobs WHERE dedup_key = ? AND status = 'completed' ORDER BY created_at DESC",
+                (dedup_key,),
+            ).fetchall()
+        for job_id, data in rows:
+            if job_id == exclude_id:
                 continue
-            job.status = "running"
-            executor.submit(run_transcode_job_wrapper, job.id)
+            job = JobStatus.model_validate_json(data)
+            try:
+                if job.outputs and os.path.getsize(job.outputs[0]) == job.output_size:
+                    return job
+            except OSError:
+                continue
+        return None
+
+    def active_jobs(self, status: Optional[str] = None) -> List[JobStatus]:
+        """返回内存中未结束的任务（不访问数据库）"""
+        with self._lock:
+            return [j for j in self._active.values() if status is None or j.status == status]
+
+    def list(self, statuses: Optional[List[str]] = None, batch_id: Optional[str] = None) -> List[JobStatus]:
+        """按创建时间倒序返回任务，未结束的任务使用内存中的最新对象"""
+        where = []
+        args: List[Any] = []
+        if statuses:
+            where.append(f"status IN ({','.join('?' * len(statuses))})")
+            args.extend(statuses)
+        if batch_id:
+            where.append("batch_id = ?")
+            args.append(batch_id)
+        sql = "SELECT id, data FROM jobs"
+        if where:
+            sql += f" WHERE {' AND '.join(where)}"
+        sql += " ORDER BY created_at DESC, rowid DESC"
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+            active = dict(self._active)
+        return [active.get(job_id) or JobStatus.model_validate_json(data) for job_id, data in rows]
 
-def run_transcode_job_wrapper(job_id: str):
-    """包装转码任务，确保完成后触发调度"""
+    def query(
+        self,
+        statuses: Optional[List[str]] = None,
+        since: Optional[int] = None,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        batch_id: Optional[str] = None,
+    ) -> Tuple[int, List[JobStatus]]:
+        """按条件分页查询任务，返回 (总数, 当前页)，按创建时间倒序
+
+        since 只返回修订号大于该值的任务。运行中任务的进度变化只记录在内存里，
+        所以未结束的任务总是从数据库取出后再按内存中的修订号过滤。
+        """
+        where = []
+        args: List[Any] = []
+        if statuses:
+            where.append(f"status IN ({','.join('?' * len(statuses))})")
+            args.extend(statuses)
+        if batch_id:
+            where.append("batch_id = ?")
+            args.append(batch_id)
+        if since is not None:
+            where.append("(revision > ? OR status IN ('preparing', 'pending', 'running'))")
+            args.append(since)
+        where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+        sql = f"SELECT id, data FROM jobs{where_sql} ORDER BY created_at DESC, rowid DESC"
+
+        with self._lock:
+            if since is None:
+                total = self._conn.execute(f"SELECT COUNT(*) FROM jobs{where_sql}", args).fetchone()[0]
+                if limit is not None:
+                    sql += " LIMIT ? OFFSET ?"
+                    args = args + [limit, offset]
+            rows = self._conn.execute(sql, args).fetchall()
+            active = dict(self._active)
+
+        jobs = [active.get(job_id) or JobStatus.model_validate_json(data) for job_id, data in rows]
+        if since is not None:
+            jobs = [j for j in jobs if j.revision > since]
+            total = len(jobs)
+            jobs = jobs[offset:offset + limit] if limit is not None else jobs[offset:]
+        return total, jobs
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def delete_by_status(self, status: str) -> int:
+        with self._lock:
+            job_ids = [row[0] for row in self._conn.execute("SELECT id FROM jobs WHERE status = ?", (status,))]
+            self._conn.execute("DELETE FROM jobs WHERE status = ?", (status,))
+            # 任务全部删除的批次一并删除
+            for batch_id in BATCHES.forget(job_ids):
+                self._conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+        JOB_EVENTS.remove(job_ids)
+        return len(job_ids)
+
+JOB_STORE = JobStore(CONFIG_DIR / "jobs.db")
+JOB_STORE.recover()
+# job_id -> 该任务当前运行的 ffmpeg 进程 (分段转码时同时有多个)
+JOB_PROCESSES: Dict[str, List[subprocess.Popen]] = {}
+JOB_PROCESSES_LOCK = threading.Lock()
+
+def terminate_job_processes(job_id: str):
+    """终止任务的所有 ffmpeg 进程"""
+    with JOB_PROCESSES_LOCK:
+        processes = list(JOB_PROCESSES.get(job_id, []))
+    for process in processes:
+        try:
+            process.terminate()
+        except Exception as e:
+            print(f"Error terminating process: {e}")
+
+# 并发控制
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 2))
+
+def _available_cpus() -> int:
+    """容器内实际可用的 CPU 数 (考虑 CPU 亲和性限制)"""
     try:
-        run_transcode_job(job_id)
-    finally:
-        # 任务结束（无论成功失败），尝试启动新任务
-        try_start_jobs()
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 4
+
+def _available_memory_mb() -> int:
+    """读取 /proc/meminfo 中的 MemAvailable，读取失败时按 4GB 估算"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 4096
+
+# 资源预算：同时运行的任务估算占用之和不超过这里的 CPU 核数和内存
+CPU_BUDGET = int(os.environ.get("CPU_BUDGET", _available_cpus()))
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", _available_memory_mb() * 0.8))
+# 缺少资源估算时的占用 (1080p x264 medium 基准)
+DEFAULT_JOB_COST = (min(4, CPU_BUDGET), 500)
+# 预览并发数随 CPU 核数伸缩 (每 4 核 1 个)，防止短时间内大量启动 FFmpeg 导致内存溢出
+PREVIEW_CONCURRENCY = int(os.environ.get("PREVIEW_CONCURRENCY", max(1, CPU_BUDGET // 4)))
+PREVIEW_QUEUE_SIZE = int(os.environ.get("PREVIEW_QUEUE_SIZE", 32))
+PREVIEW_QUEUE_TIMEOUT = float(os.environ.get("PREVIEW_QUEUE_TIMEOUT", 120))
+
+class JobScheduler:
+    """优先级调度器
+
+    待处理任务按 (优先级降序, 创建时间, 提交顺序) 存放在堆中，由一个专用分发线程
+    在有空闲槽位时取出并启动；pending -> running 的状态切换在锁内完成，
+    因此并发数不会超过 MAX_CONCURRENT_JOBS。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.RLock())
+        self._heap: List[list] = []
+        # job_id -> 堆条目，取消或调整优先级时将条目置为无效 (惰性删除)
+        self._entries: Dict[str, list] = {}
+        self._seq = itertools.count()
+        self._running = 0
+        self._used_cores = 0
+        self._used_memory_mb = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running_count(self) -> int:
+        return self._running
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._entries)
+
+    @property
+    def used_cores(self) -> int:
+        return self._used_cores
+
+    @property
+    def used_memory_mb(self) -> int:
+        return self._used_memory_mb
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch_loop, name="job-dispatcher", daemon=True)
+                self._thread.start()
+
+    def _push(self, job: JobStatus):
+        old = self._entries.pop(job.id, None)
+        if old is not None:
+            old[-1] = None
+        entry = [-job.priority, job.created_at, next(self._seq), job.id]
+        self._entries[job.id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def submit(self, jobs: List[JobStatus]):
+        """将 pending 任务加入调度队列"""
+        for job in jobs:
+            if job.status == "pending" and (job.cost_cores is None or job.cost_memory_mb is None):
+                # 旧版本创建的任务没有资源估算；可能需要 ffprobe，必须在锁外完成
+                try:
+                    job.cost_cores, job.cost_memory_mb = estimate_job_cost(job)
+                except Exception:
+                    job.cost_cores, job.cost_memory_mb = DEFAULT_JOB_COST
+        with self._cond:
+            for job in jobs:
+                if job.status == "pending":
+                    self._push(job)
+            self._cond.notify()
+
+    def ready(self, job: JobStatus):
+        """元数据准备完毕：preparing -> pending 并加入调度队列；期间已被取消的任务保持不变"""
+        with self._cond:
+            if job.status != "preparing":
+                return
+            job.status = "pending"
+            JOB_STORE.save(job)
+            self._push(job)
+            self._cond.notify()
+
+    def set_priority(self, jobs: List[JobStatus], priority: int):
+        with self._cond:
+            for job in jobs:
+                job.priority = priority
+                if job.status == "pending":
+                    self._push(job)
+            JOB_STORE.save_many(jobs)
+            self._cond.notify()
+
+    def cancel(self, jobs: List[JobStatus]) -> List[JobStatus]:
+        """取消未结束的任务，返回实际被取消的任务"""
+        cancelled = []
+        with self._cond:
+            for job in jobs:
+                if job.status not in ACTIVE_STATUSES:
+                    continue
+                entry = self._entries.pop(job.id, None)
+                if entry is not None:
+                    entry[-1] = None
+                # 终止进程
+                if job.status == "running":
+                    terminate_job_processes(job.id)
+                job.status = "cancelled"
+                cancelled.append(job)
+            JOB_STORE.save_many(cancelled)
+        return cancelled
+
+    def wake(self):
+        """并发数变化后唤醒分发线程"""
+        with self._cond:
+            self._cond.notify()
+
+    def _fits(self, job: JobStatus) -> bool:
+        # 没有任务在运行时总是放行，避免超出预算的大任务永远无法启动
+        if self._running == 0:
+            return True
+        return (self._used_cores + job.cost_cores <= CPU_BUDGET
+                and self._used_memory_mb + job.cost_memory_mb <= MEMORY_BUDGET_MB)
+
+    def _pop_next(self) -> Optional[JobStatus]:
+        """取出队首任务；队首在资源预算内放不下时返回 None 并等待，保证大任务不被小任务饿死"""
+        if self._running >= MAX_CONCURRENT_JOBS:
+            return None
+        while self._heap:
+            entry = self._heap[0]
+            job_id = entry[-1]
+            if job_id is None:
+                heapq.heappop(self._heap)
+                continue
+            job = JOB_STORE.get(job_id)
+            if job is None or job.status != "pending":
+                heapq.heappop(self._heap)
+                del self._entries[job_id]
+                continue
+            if job.cost_cores is None or job.cost_memory_mb is None:
+                # submit 时已估算，这里只兜底，不能在锁内探测
+                job.cost_cores, job.cost_memory_mb = DEFAULT_JOB_COST
+            if not self._fits(job):
+                return None
+            heapq.heappop(self._heap)
+            del self._entries[job_id]
+            return job
+        return None
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                job = self._pop_next()
+                while job is None:
+                    self._cond.wait()
+                    job = self._pop_next()
+                job.status = "running"
+                JOB_STORE.save(job)
+                self._running += 1
+                self._used_cores += job.cost_cores
+                self._used_memory_mb += job.cost_memory_mb
+            threading.Thread(target=self._run_job, args=(job,), name=f"job-{job.id[:8]}", daemon=True).start()
+
+    def _run_job(self, job: JobStatus):
+        cost = (job.cost_cores, job.cost_memory_mb)
+        started = time.monotonic()
+        try:
+            run_transcode_job(job.id)
+        finally:
+            JOB_WALL_SECONDS.observe(time.monotonic() - started, job.status)
+            if job.status == "completed" and not job.reused_from:
+                JOB_BYTES_READ.inc(job.input_size or 0)
+                JOB_BYTES_WRITTEN.inc(job.output_size or 0)
+            # 任务结束（无论成功失败），释放槽位和资源并唤醒分发线程
+            with self._cond:
+                self._running -= 1
+                self._used_cores -= cost[0]
+                self._used_memory_mb -= cost[1]
+                self._cond.notify()
+
+SCHEDULER = JobScheduler()
 
 class TranscodeParams(BaseModel):
     vcodec: Optional[str] = "libx264"
@@ -121,11 +867,25 @@ class TranscodeParams(BaseModel):
     deinterlace: bool = False
     rotation: Optional[str] = None
     extra_args: Optional[List[str]] = None
+    segments: Optional[int] = None # 分段并行转码的段数，仅 CPU 编码的长视频生效
+    stream_copy: bool = True # 源流已符合目标编码/码率/分辨率时直接复制，只需改封装时变为秒级 remux
+    target_size: Optional[str] = None # 目标文件大小 (如 4G、700M)，设置后按时长计算视频码率并两遍编码
+    audio_bitrate: Optional[str] = None # 音频码率 (如 128k)
 
 class TranscodeRequest(BaseModel):
     inputs: List[str]
     params: TranscodeParams
     output_dir: Optional[str] = None
+    priority: int = 0
+
+# 阻塞任务线程池：bcrypt 哈希、ffmpeg 截图等 CPU 密集或子进程操作在这里执行，不占用事件循环
+BLOCKING_WORKERS = int(os.environ.get("BLOCKING_WORKERS", 4))
+BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+async def run_blocking(func, *args):
+    """在阻塞任务线程池中执行 func(*args) 并等待结果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BLOCKING_EXECUTOR, func, *args)
 
 # --- Auth Configuration ---
 SECRET_KEY = os.environ.get("SECRET_KEY", "ffmpeg-web-ui-secret-key-change-this")
@@ -175,7 +935,19 @@ def verify_password(plain_password, hashed_password):
     except ValueError:
         return False
 
-def load_users():
+# users.json 的内存缓存，按文件 mtime/大小判断是否失效
+_users_lock = threading.Lock()
+_users_cache: Dict[str, Any] = {}
+_users_cache_key: Optional[tuple] = None
+
+def _users_file_key() -> Optional[tuple]:
+    try:
+        st = USERS_FILE.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _read_users_file():
     if not USERS_FILE.exists():
         return {}
     try:
@@ -187,9 +959,27 @@ def load_users():
     except:
         return {}
 
+def get_cached_users() -> Dict[str, Any]:
+    """返回缓存的用户表 (只读)，文件未变化时不读取磁盘"""
+    global _users_cache, _users_cache_key
+    key = _users_file_key()
+    with _users_lock:
+        if key is None or key != _users_cache_key:
+            _users_cache = _read_users_file()
+            _users_cache_key = key
+        return _users_cache
+
+def load_users():
+    """返回用户表的副本，可修改后传给 save_users"""
+    return copy.deepcopy(get_cached_users())
+
 def save_users(users_db):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users_db, f, indent=2)
+    global _users_cache, _users_cache_key
+    with _users_lock:
+        with open(USERS_FILE, "w") as f:
+            json.dump(users_db, f, indent=2)
+        _users_cache = copy.deepcopy(users_db)
+        _users_cache_key = _users_file_key()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -201,21 +991,98 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# 已验证 token 的缓存: token -> (username, 过期时间戳)
+TOKEN_CACHE_SIZE = 1024
+_token_lock = threading.Lock()
+_token_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+def decode_token_username(token: str) -> Optional[str]:
+    """验证 JWT 并返回用户名，已验证且未过期的 token 直接从缓存返回"""
+    now = time.time()
+    with _token_lock:
+        cached = _token_cache.get(token)
+        if cached is not None:
+            if cached[1] > now:
+                _token_cache.move_to_end(token)
+                return cached[0]
+            del _token_cache[token]
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    expire = payload.get("exp")
+    if username is None:
+        return None
+    if expire is not None:
+        with _token_lock:
+            _token_cache[token] = (username, float(expire))
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+    return username
+
+class LoginThrottle:
+    """按 用户名+客户端 IP 的登录失败次数限制 (滑动窗口)，成功登录不计数"""
+
+    def __init__(self, max_attempts: int, window: float):
+        self.max_attempts = max_attempts
+        self.window = window
+        self._lock = threading.Lock()
+        self._failures: Dict[str, deque] = {}
+
+    def retry_after(self, key: str) -> Optional[float]:
+        """失败次数超出限制时返回需要等待的秒数"""
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.get(key)
+            if not failures:
+                return None
+            while failures and now - failures[0] > self.window:
+                failures.popleft()
+            if len(failures) >= self.max_attempts:
+                return self.window - (now - failures[0])
+            return None
+
+    def record_failure(self, key: str):
+        now = time.monotonic()
+        with self._lock:
+            self._failures.setdefault(key, deque()).append(now)
+            # 顺便清理长时间没有失败记录的键
+            if len(self._failures) > 1024:
+                for k in [k for k, q in self._failures.items() if not q or now - q[-1] > self.window]:
+                    del self._failures[k]
+
+    def reset(self, key: str):
+        with self._lock:
+            self._failures.pop(key, None)
+
+LOGIN_THROTTLE = LoginThrottle(
+    int(os.environ.get("LOGIN_MAX_ATTEMPTS", 10)),
+    float(os.environ.get("LOGIN_WINDOW_SECONDS", 60)),
+)
+# 反向代理的地址 (逗号分隔)；只有来自这些地址的请求才采信 X-Forwarded-For
+TRUSTED_PROXIES = {ip.strip() for ip in os.environ.get("TRUSTED_PROXIES", "").split(",") if ip.strip()}
+
+def client_address(request: Request) -> str:
+    """客户端真实 IP：直连地址是受信任的代理时，取 X-Forwarded-For 中最右侧的非代理地址"""
+    ip = request.client.host if request.client else "unknown"
+    if ip in TRUSTED_PROXIES:
+        forwarded = [p.strip() for p in request.headers.get("x-forwarded-for", "").split(",") if p.strip()]
+        while forwarded and ip in TRUSTED_PROXIES:
+            ip = forwarded.pop()
+    return ip
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
+    username = decode_token_username(token)
+    if username is None:
         raise credentials_exception
     
-    users_db = load_users()
+    users_db = get_cached_users()
     user_data = users_db.get(username)
     if user_data is None:
         raise credentials_exception
@@ -226,48 +1093,420 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 
 # --- End Auth Configuration ---
 
+class ProbeCache:
+    """ffprobe 结果缓存
+
+    以 (路径, 大小, mtime, inode) 为键保存完整的 ffprobe JSON (format + streams)，
+    内存 LRU 在前，CONFIG_DIR 下的 SQLite 在后；文件被替换或修改后键随之失效。
+    """
+
+    def __init__(self, db_path: Path, capacity: int = 4096):
+        self._lock = threading.Lock()
+        self._capacity = capacity
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS probes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                data TEXT NOT NULL
+            )
+        """)
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, path: str, fingerprint: tuple, info: Dict[str, Any]):
+        self._memory[path] = (fingerprint, info)
+        self._memory.move_to_end(path)
+        while len(self._memory) > self._capacity:
+            self._memory.popitem(last=False)
+
+    def lookup(self, path: str, fingerprint: tuple) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cached = self._memory.get(path)
+            if cached and cached[0] == fingerprint:
+                self._memory.move_to_end(path)
+                return cached[1]
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, data FROM probes WHERE path = ?", (path,)
+            ).fetchone()
+            if row and tuple(row[:3]) == fingerprint:
+                info = json.loads(row[3])
+                self._remember(path, fingerprint, info)
+                return info
+        return None
+
+    def store(self, path: str, fingerprint: tuple, info: Dict[str, Any]):
+        with self._lock:
+            self._remember(path, fingerprint, info)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO probes (path, size, mtime_ns, inode, data) VALUES (?, ?, ?, ?, ?)",
+                (path, *fingerprint, json.dumps(info)),
+            )
+
+    def probe(self, input_path: Path) -> Optional[Dict[str, Any]]:
+        """返回文件的 ffprobe 信息，缓存未命中时才启动 ffprobe；失败返回 None"""
+        try:
+            st = input_path.stat()
+        except OSError:
+            return None
+        path = str(input_path)
+        fingerprint = (st.st_size, st.st_mtime_ns, st.st_ino)
+        info = self.lookup(path, fingerprint)
+        if info is not None:
+            self.hits += 1
+            return info
+        self.misses += 1
+        try:
+            cmd = [
+                "ffprobe",
+                "-v", "error",
+                "-show_format", "-show_streams",
+                "-of", "json",
+                path
+            ]
+            started = time.monotonic()
+            ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            FFPROBE_SECONDS.observe(time.monotonic() - started)
+            if ret.returncode != 0:
+                return None
+            info = json.loads(ret.stdout)
+        except:
+            return None
+        self.store(path, fingerprint, info)
+        return info
+
+PROBE_CACHE_SIZE = int(os.environ.get("PROBE_CACHE_SIZE", 4096))
+PROBE_CACHE = ProbeCache(CONFIG_DIR / "probe_cache.db", PROBE_CACHE_SIZE)
+
+def probe_media(input_path: Path) -> Optional[Dict[str, Any]]:
+    """获取完整的 ffprobe 信息 (带缓存)"""
+    return PROBE_CACHE.probe(input_path)
+
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+_fingerprint_cache: "OrderedDict[tuple, str]" = OrderedDict()
+_fingerprint_lock = threading.Lock()
+
+def content_fingerprint(path: Path) -> Optional[str]:
+    """文件内容指纹：大小 + 均匀分布 (含首尾) 的若干数据块的 sha256，读取量与文件大小无关
+
+    同一文件改名或复制后指纹不变；按 (路径, 大小, mtime, inode) 缓存。
+    """
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    key = (str(path), st.st_size, st.st_mtime_ns, st.st_ino)
+    with _fingerprint_lock:
+        cached = _fingerprint_cache.get(key)
+        if cached is not None:
+            _fingerprint_cache.move_to_end(key)
+            return cached
+
+    size = st.st_size
+    h = hashlib.sha256(str(size).encode())
+    try:
+        with open(path, "rb") as f:
+            if size <= FINGERPRINT_BLOCKS * FINGERPRINT_BLOCK_SIZE:
+                h.update(f.read())
+            else:
+                step = (size - FINGERPRINT_BLOCK_SIZE) // (FINGERPRINT_BLOCKS - 1)
+                for i in range(FINGERPRINT_BLOCKS):
+                    f.seek(i * step)
+                    h.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    except OSError:
+        return None
+    fingerprint = f"{size}-{h.hexdigest()}"
+
+    with _fingerprint_lock:
+        _fingerprint_cache[key] = fingerprint
+        while len(_fingerprint_cache) > PROBE_CACHE_SIZE:
+            _fingerprint_cache.popitem(last=False)
+    return fingerprint
+
+def params_hash(params: TranscodeParams) -> str:
+    """转码参数的规范化哈希；线程数和分段数不影响输出内容，不参与计算"""
+    normalized = params.model_dump(exclude={"threads", "segments"})
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def dedup_key(input_path: Path, params: TranscodeParams) -> Optional[str]:
+    fingerprint = content_fingerprint(input_path)
+    return f"{fingerprint}:{params_hash(params)}" if fingerprint else None
+
+def reuse_output(source: Path, output_path: Path) -> bool:
+    """把已有输出放到 output_path：同一文件系统用硬链接，否则复制；失败返回 False"""
+    try:
+        if output_path.exists() and os.path.samefile(source, output_path):
+            return True
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            try:
+                os.link(source, tmp)
+            except OSError:
+                shutil.copyfile(source, tmp)
+            os.replace(tmp, output_path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return True
+    except OSError as e:
+        print(f"Reuse output failed: {e}")
+        return False
+
 def get_video_duration(input_path: Path) -> float:
     """使用 ffprobe 获取视频时长(秒)"""
+    info = probe_media(input_path)
     try:
-        cmd = [
-            "ffprobe", 
-            "-v", "error", 
-            "-show_entries", "format=duration", 
-            "-of", "default=noprint_wrappers=1:nokey=1", 
-            str(input_path)
-        ]
-        ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if ret.returncode == 0:
-            return float(ret.stdout.strip())
+        return float(info["format"]["duration"])
     except:
-        pass
-    return 0.0
+        return 0.0
+
+# 各编码预设相对 medium 的 CPU 开销系数
+PRESET_COST = {
+    "ultrafast": 0.3, "superfast": 0.4, "veryfast": 0.5, "faster": 0.7, "fast": 0.85,
+    "medium": 1.0, "slow": 1.5, "slower": 2.0, "veryslow": 2.5, "placebo": 3.0,
+}
+
+def get_video_stream(info: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """返回 ffprobe 信息中的第一个视频流 (跳过封面图)"""
+    for stream in (info or {}).get("streams", []):
+        if stream.get("codec_type") == "video" and not stream.get("disposition", {}).get("attached_pic"):
+            return stream
+    return None
+
+def output_dimensions(params: "TranscodeParams", info: Optional[Dict[str, Any]]) -> Tuple[int, int]:
+    """估算输出分辨率，未知时按 1080p 计算"""
+    stream = get_video_stream(info) or {}
+    src_w, src_h = stream.get("width") or 1920, stream.get("height") or 1080
+    if not params.resolution:
+        return src_w, src_h
+    parts = re.split(r"[:x]", params.resolution)
+    try:
+        w, h = int(parts[0]), int(parts[1])
+    except (ValueError, IndexError):
+        return src_w, src_h
+    # -1 / -2 表示按源比例计算
+    if w <= 0 and h > 0:
+        w = int(h * src_w / src_h)
+    elif h <= 0 and w > 0:
+        h = int(w * src_h / src_w)
+    elif w <= 0 and h <= 0:
+        w, h = src_w, src_h
+    return w, h
+
+# 编码器 -> 输出的编码格式
+ENCODER_CODECS = {
+    "libx264": "h264", "h264_nvenc": "h264", "h264_qsv": "h264", "h264_vaapi": "h264",
+    "libx265": "hevc", "hevc_nvenc": "hevc", "hevc_qsv": "hevc", "hevc_vaapi": "hevc",
+    "libvpx": "vp8", "libvpx-vp9": "vp9", "libaom-av1": "av1", "libsvtav1": "av1", "av1_nvenc": "av1",
+    "aac": "aac", "libfdk_aac": "aac", "libopus": "opus", "opus": "opus", "libvorbis": "vorbis",
+    "libmp3lame": "mp3", "ac3": "ac3", "eac3": "eac3", "flac": "flac",
+    "mov_text": "mov_text", "srt": "subrip", "subrip": "subrip", "ass": "ass", "webvtt": "webvtt",
+}
+
+# 各封装格式可直接容纳的编码；不在表中的格式 (mkv) 不做限制
+CONTAINER_CODECS = {
+    "mp4": {
+        "video": {"h264", "hevc", "av1", "vp9", "mpeg4"},
+        "audio": {"aac", "mp3", "ac3", "eac3", "opus", "flac", "alac"},
+        "subtitle": {"mov_text"},
+    },
+    "mov": {
+        "video": {"h264", "hevc", "mpeg4", "prores", "mjpeg"},
+        "audio": {"aac", "mp3", "ac3", "eac3", "alac", "pcm_s16le", "pcm_s24le"},
+        "subtitle": {"mov_text"},
+    },
+    "webm": {
+        "video": {"vp8", "vp9", "av1"},
+        "audio": {"opus", "vorbis"},
+        "subtitle": {"webvtt"},
+    },
+}
+
+# 封装格式默认使用的文本字幕编码
+CONTAINER_TEXT_SUBTITLE = {"mp4": "mov_text", "mov": "mov_text", "webm": "webvtt"}
+TEXT_SUBTITLE_CODECS = {"subrip", "ass", "ssa", "mov_text", "webvtt", "text"}
+
+def parse_bitrate(value: Optional[str]) -> Optional[int]:
+    """把 2M / 2500k / 800000 这样的码率解析为 bit/s"""
+    if not value:
+        return None
+    m = re.fullmatch(r"\s*([\d.]+)\s*([kKmMgG]?)\s*", str(value))
+    if not m:
+        return None
+    return int(float(m[1]) * {"": 1, "k": 1e3, "m": 1e6, "g": 1e9}[m[2].lower()])
+
+def _stream_bitrate(stream: Dict[str, Any], info: Dict[str, Any]) -> Optional[int]:
+    if stream.get("bit_rate"):
+        return int(stream["bit_rate"])
+    # mkv 等格式没有单流码率：用总码率减去其他流的码率估算
+    total = (info.get("format") or {}).get("bit_rate")
+    if not total:
+        return None
+    others = sum(int(s.get("bit_rate") or 0) for s in info.get("streams", []) if s is not stream)
+    return int(total) - others
+
+def plan_streams(info: Optional[Dict[str, Any]], params: "TranscodeParams") -> Optional[Dict[str, Any]]:
+    """根据完整的 ffprobe 流信息逐流决定复制、重新编码还是丢弃
+
+    返回 {"mode": "remux"|"transcode", "streams": [{index, type, codec, action, encoder, reason}]}；
+    无法探测时返回 None，由 build_ffmpeg_cmd 沿用 -map 0 全部重新编码。
+    """
+    if not info or not info.get("streams"):
+        return None
+    fmt = (params.format or "mp4").lower()
+    allowed = CONTAINER_CODECS.get(fmt)
+    target_w, target_h = output_dimensions(params, info) if params.resolution else (None, None)
+    requested_bitrate = parse_bitrate(params.bitrate)
+    requested_audio = parse_bitrate(params.audio_bitrate)
+    # 有滤镜或自定义参数时无法判断能否复制
+    needs_filter = params.deinterlace or bool(params.rotation)
+
+    streams = []
+    for stream in info["streams"]:
+        kind = stream.get("codec_type")
+        codec = stream.get("codec_name")
+        entry = {"index": stream.get("index"), "type": kind, "codec": codec, "action": "encode", "encoder": None, "reason": ""}
+
+        def container_ok(c):
+            return allowed is None or c in allowed.get(kind, set())
+
+        if kind == "video":
+            if stream.get("disposition", {}).get("attached_pic"):
+                entry.update(action="drop", reason="封面图")
+            elif (params.vcodec or "").lower() == "copy":
+                entry.update(action="copy", reason="参数指定复制")
+            else:
+                target = ENCODER_CODECS.get(params.vcodec or "", params.vcodec)
+                bitrate = _stream_bitrate(stream, info)
+                if not params.stream_copy or params.extra_args:
+                    entry["reason"] = "未启用智能复制"
+                elif params.crf is not None:
+                    # 指定了质量目标就必须重新编码
+                    entry["reason"] = f"CRF {params.crf}"
+                elif not requested_bitrate:
+                    # 只有明确指定目标码率且源码率不超过它时才能判断源视频已符合目标
+                    entry["reason"] = "未指定目标码率"
+                elif codec != target:
+                    entry["reason"] = f"{codec} -> {target}"
+                elif needs_filter:
+                    entry["reason"] = "需要反交错/旋转"
+                elif target_w and ((stream.get("width") or 0) > target_w or (stream.get("height") or 0) > target_h):
+                    entry["reason"] = f"缩放到 {target_w}x{target_h}"
+                elif bitrate is None or bitrate > requested_bitrate:
+                    entry["reason"] = "码率高于目标" if bitrate else "源码率未知"
+                elif not container_ok(codec):
+                    entry["reason"] = f"{fmt} 不支持 {codec}"
+                else:
+                    entry.update(action="copy", reason="源视频已符合目标")
+                if entry["action"] == "encode":
+                    entry["encoder"] = params.vcodec
+        elif kind == "audio":
+            target = ENCODER_CODECS.get(params.acodec or "", params.acodec)
+            if (params.acodec or "").lower() == "copy":
+                entry.update(action="copy", reason="参数指定复制")
+            elif not params.stream_copy or params.extra_args:
+                entry.update(encoder=params.acodec, reason="未启用智能复制")
+            elif not container_ok(codec):
+                entry.update(encoder=params.acodec, reason=f"{fmt} 不支持 {codec}")
+            elif params.acodec and codec != target:
+                entry.update(encoder=params.acodec, reason=f"{codec} -> {target}")
+            elif requested_audio and not 0 < (_stream_bitrate(stream, info) or 0) <= requested_audio:
+                entry.update(encoder=params.acodec, reason="码率高于目标")
+            else:
+                entry.update(action="copy", reason="源音频已符合目标")
+        elif kind == "subtitle":
+            scodec = (params.scodec or "none").lower()
+            text_target = CONTAINER_TEXT_SUBTITLE.get(fmt)
+            if scodec == "none":
+                entry.update(action="drop", reason="已禁用字幕")
+            elif scodec == "copy" and container_ok(codec):
+                entry.update(action="copy", reason="直接复制")
+            elif codec not in TEXT_SUBTITLE_CODECS:
+                # 图形字幕 (PGS/DVB/VobSub) 无法转成文本字幕
+                entry.update(action="drop", reason=f"{fmt} 不支持图形字幕 {codec}")
+            else:
+                entry.update(encoder=text_target if scodec == "copy" else scodec, reason="转换文本字幕")
+        elif kind == "attachment" and allowed is None:
+            entry.update(action="copy", reason="附件 (字体等)")
+        else:
+            entry.update(action="drop", reason=f"{fmt} 不支持 {kind} 流")
+        streams.append(entry)
+
+    video_encoded = any(s["type"] == "video" and s["action"] == "encode" for s in streams)
+    return {"mode": "transcode" if video_encoded else "remux", "streams": streams}
+
+def plan_encodes_video(plan: Optional[Dict[str, Any]]) -> bool:
+    return plan is None or plan["mode"] == "transcode"
+
+def estimate_job_cost(job: "JobStatus", info: Optional[Dict[str, Any]] = None) -> Tuple[int, int]:
+    """根据参数和探测数据估算任务占用 (CPU 核数, 内存 MB)
+
+    以 1080p x264 medium 约 4 核、500MB 为基准，按像素数、编码器和预设缩放；
+    硬件编码和直接复制只计 1 核。
+    """
+    params = TranscodeParams(**job.params)
+    if not plan_encodes_video(job.plan):
+        # 仅封装：主要是 IO
+        return 1, 200
+    if info is None and job.inputs:
+        info = probe_media(Path(job.inputs[0]))
+    w, h = output_dimensions(params, info)
+    scale = (w * h) / (1920 * 1080)
+    vcodec = (params.vcodec or "").lower()
+
+    if (params.hw_accel and params.hw_accel != "cpu") or vcodec in ("", "copy"):
+        cores = 1.0
+        memory = 300 + 200 * scale
+    else:
+        codec_factor = 2.0 if ("265" in vcodec or "hevc" in vcodec or "av1" in vcodec or "vp9" in vcodec) else 1.0
+        preset_factor = PRESET_COST.get((params.preset or "medium").lower(), 1.0)
+        cores = 4.0 * scale * codec_factor * preset_factor
+        memory = 200 + 300 * scale * codec_factor * max(1.0, preset_factor)
+
+    if can_segment(params, job.duration):
+        # 分段模式本身就会占满所有核心
+        cores = CPU_BUDGET
+        memory *= min(params.segments, CPU_BUDGET)
+    if params.threads:
+        cores = params.threads
+    return max(1, min(CPU_BUDGET, int(round(cores)))), int(memory)
 
 # 核心转码逻辑
-def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParams, input_options: List[str] = None) -> List[str]:
+def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParams, input_options: List[str] = None,
+                     plan: Optional[Dict[str, Any]] = None) -> List[str]:
+    """构建 ffmpeg 命令；给出 plan (见 plan_streams) 时按流映射并复制/编码/丢弃，否则 -map 0 全部编码"""
     cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "info"]
 
     # 硬件加速配置 (必须在 -i 之前)
     use_cuda = False
     use_qsv = False
     use_vaapi = False
+    # 视频直接复制时不需要解码，也不需要视频编码参数和滤镜
+    encode_video = plan_encodes_video(plan)
+    hw_accel = params.hw_accel if encode_video else None
     
-    if params.hw_accel and params.hw_accel.startswith("cuda"):
+    if hw_accel and hw_accel.startswith("cuda"):
         use_cuda = True
         cmd.extend(["-hwaccel", "cuda"])
         cmd.extend(["-hwaccel_output_format", "cuda"])
         
         # 指定 GPU 设备
-        if ":" in params.hw_accel:
-            device_idx = params.hw_accel.split(":")[1]
+        if ":" in hw_accel:
+            device_idx = hw_accel.split(":")[1]
             cmd.extend(["-hwaccel_device", device_idx])
             
-    elif params.hw_accel == "qsv":
+    elif hw_accel == "qsv":
         use_qsv = True
         cmd.extend(["-hwaccel", "qsv"])
         cmd.extend(["-hwaccel_output_format", "qsv"])
         
-    elif params.hw_accel == "vaapi":
+    elif hw_accel == "vaapi":
         use_vaapi = True
         # AMD/Intel VAAPI 通用配置
         cmd.extend(["-hwaccel", "vaapi"])
@@ -279,8 +1518,26 @@ def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParam
 
     cmd.extend(["-i", str(input_path)])
     
-    # 关键：映射所有流 (视频/音频/字幕)
-    cmd.extend(["-map", "0"])
+    if plan is not None:
+        # 按计划逐流映射，输出流序号即 kept 中的位置；视频流排在最前 (两遍编码的日志按输出流序号命名)
+        kept = sorted((s for s in plan["streams"] if s["action"] != "drop"), key=lambda s: s["type"] != "video")
+        for s in kept:
+            cmd.extend(["-map", f"0:{s['index']}"])
+        for out_idx, s in enumerate(kept):
+            if s["action"] == "copy":
+                cmd.extend([f"-c:{out_idx}", "copy"])
+            elif s["type"] == "video":
+                # 视频编码器在下面统一处理 (含硬件编码器替换)
+                continue
+            elif s["encoder"]:
+                cmd.extend([f"-c:{out_idx}", s["encoder"]])
+        if not encode_video and any(s["type"] == "video" and s["codec"] == "hevc" for s in kept) \
+                and (params.format or "").lower() in ("mp4", "mov"):
+            # 复制 HEVC 到 MP4/MOV 时使用 hvc1 标记以兼容 Apple 设备
+            cmd.extend(["-tag:v", "hvc1"])
+    else:
+        # 关键：映射所有流 (视频/音频/字幕)
+        cmd.extend(["-map", "0"])
 
     # 视频编码器自动切换
     vcodec = params.vcodec
@@ -290,20 +1547,30 @@ def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParam
         elif vcodec == "libx265":
             vcodec = "hevc_nvenc"
             
-    if vcodec:
-        cmd.extend(["-c:v", vcodec])
-        
-    if params.acodec:
-        cmd.extend(["-c:a", params.acodec])
-    
-    # 字幕处理
-    if params.scodec and params.scodec.lower() != "none":
-        cmd.extend(["-c:s", params.scodec])
+    if plan is not None:
+        # 逐流的编码器已在映射时设置
+        for out_idx, s in enumerate(kept):
+            if s["type"] == "video" and s["action"] == "encode" and vcodec:
+                cmd.extend([f"-c:{out_idx}", vcodec])
     else:
-        # 显式禁用字幕
-        cmd.extend(["-sn"])
+        if vcodec:
+            cmd.extend(["-c:v", vcodec])
+            
+        if params.acodec:
+            cmd.extend(["-c:a", params.acodec])
+        
+        # 字幕处理
+        if params.scodec and params.scodec.lower() != "none":
+            cmd.extend(["-c:s", params.scodec])
+        else:
+            # 显式禁用字幕
+            cmd.extend(["-sn"])
 
-    if params.bitrate:
+    if params.audio_bitrate:
+        cmd.extend(["-b:a", params.audio_bitrate])
+
+    # 仅封装时不附加视频编码参数和滤镜
+    if encode_video and params.bitrate:
         cmd.extend(["-b:v", params.bitrate])
         
     # CRF (注意: nvenc 也支持 -cq/-rc 等，但简单的 -crf 可能被忽略或需要改用 -cq，这里暂且保留，ffmpeg 通常会做适配或忽略)
@@ -311,7 +1578,7 @@ def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParam
     # 简单起见，如果使用 nvenc 且指定了 crf，我们尝试保留原样，或者警告。
     # 实际上 ffmpeg 的 h264_nvenc 不支持 -crf，它使用 -cq (VBR) 或 -qp (CQP)
     # 为了简化，如果检测到 nvenc 且有 crf，我们尝试转换为 -cq
-    if params.crf is not None:
+    if encode_video and params.crf is not None:
         if use_cuda and "nvenc" in vcodec:
             cmd.extend(["-rc", "vbr", "-cq", str(params.crf), "-qmin", str(params.crf), "-qmax", str(params.crf)])
         elif use_qsv and "qsv" in vcodec:
@@ -320,7 +1587,7 @@ def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParam
         else:
             cmd.extend(["-crf", str(params.crf)])
             
-    if params.preset:
+    if encode_video and params.preset:
         cmd.extend(["-preset", params.preset])
         
     # 视频过滤器链 (Scale, Deinterlace, Rotate)
@@ -356,7 +1623,7 @@ def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParam
         if params.rotation in rot_map:
             filters.append(rot_map[params.rotation])
     
-    if filters:
+    if filters and encode_video:
         cmd.extend(["-vf", ",".join(filters)])
             
     if params.threads is not None and params.threads > 0:
@@ -368,101 +1635,553 @@ def build_ffmpeg_cmd(input_path: Path, output_path: Path, params: TranscodeParam
     cmd.append(str(output_path))
     return cmd
 
-def run_transcode_job(job_id: str):
-    job = JOBS[job_id]
+# 进度写入 JobStatus 的最小间隔 (秒)
+PROGRESS_UPDATE_INTERVAL = float(os.environ.get("PROGRESS_UPDATE_INTERVAL", 0.5))
+
+def with_progress_pipe(cmd: List[str]) -> List[str]:
+    """在输出路径前插入 -progress pipe:1，并关闭 stderr 上的统计行"""
+    return cmd[:-1] + ["-progress", "pipe:1", "-nostats", cmd[-1]]
+
+def _progress_float(value: Optional[str], suffix: str = "") -> Optional[float]:
+    if not value or value == "N/A":
+        return None
     try:
-        # 简单实现：顺序处理所有输入文件
-        for idx, input_file in enumerate(job.inputs):
-            # 检查任务是否已被取消
-            if job.status == "cancelled":
-                break
+        return float(value.strip().removesuffix(suffix))
+    except ValueError:
+        return None
 
-            inp = Path(input_file)
-            if not inp.exists():
-                raise FileNotFoundError(f"输入文件不存在: {inp}")
-            
-            # 确定输出路径
-            suffix = f".{job.params.get('format', 'mp4')}"
-            out_name = inp.stem + suffix
-            # 如果指定了输出目录则使用，否则默认
-            if job.outputs and len(job.outputs) > idx:
-                 # 此时 outputs 已经在创建任务时预填充了，这里确认一下
-                 pass
-            
-            # 这里简单起见，重新计算输出路径以确保正确
-            out_dir = OUTPUT_DIR
-            if job.outputs and len(job.outputs) > 0:
-                 out_dir = Path(job.outputs[0]).parent
-            
-            output_path = out_dir / out_name
-            
-            # 构建参数对象
-            params_obj = TranscodeParams(**job.params)
-            cmd = build_ffmpeg_cmd(inp, output_path, params_obj)
-            
-            # 更新任务信息中的命令（仅记录最后一条）
-            job.command = " ".join(cmd)
-            
-            # 执行命令
-            # 使用 -progress pipe:1 将进度信息输出到 stdout，方便解析
-            # 或者直接读取 stderr (ffmpeg 默认输出到 stderr)
-            # 为了稳妥，我们读取 stderr，并使用 Universal Newlines
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8", errors="replace")
-            # 存储进程对象
-            JOB_PROCESSES[job_id] = process
-            
-            # 实时读取输出以更新进度
-            # FFmpeg 输出到 stderr
-            while True:
-                line = process.stderr.readline()
-                if not line and process.poll() is not None:
-                    break
-                
-                if line:
-                    # 尝试解析时间 time=00:00:00.00
-                    # 示例: frame=  200 fps= 45 q=28.0 size=    1024kB time=00:00:10.50 bitrate= 799.0kbits/s speed=2.3x
-                    if "time=" in line:
-                        try:
-                            match = re.search(r'time=(\d{2}):(\d{2}):(\d{2}\.\d+)', line)
-                            if match:
-                                h, m, s = map(float, match.groups())
-                                current_seconds = h * 3600 + m * 60 + s
-                                if job.duration and job.duration > 0:
-                                    progress = min(100.0, (current_seconds / job.duration) * 100)
-                                    job.progress = progress
-                        except:
-                            pass
-            
-            # 等待结束
-            stdout, stderr = process.communicate() # 获取剩余输出
-            
-            # 清理进程引用
-            if job_id in JOB_PROCESSES:
-                del JOB_PROCESSES[job_id]
-            
-            # 再次检查状态
-            if job.status == "cancelled":
-                break
+def parse_progress_block(block: Dict[str, str]) -> Dict[str, Any]:
+    """解析一个 ffmpeg -progress 键值块"""
+    out_time_us = _progress_float(block.get("out_time_us"))
+    total_size = _progress_float(block.get("total_size"))
+    return {
+        "seconds": max(0.0, out_time_us / 1_000_000) if out_time_us is not None else None,
+        "fps": _progress_float(block.get("fps")),
+        "speed": _progress_float(block.get("speed"), "x"),
+        "bitrate_kbps": _progress_float(block.get("bitrate"), "kbits/s"),
+        "size": int(total_size) if total_size is not None else None,
+        "end": block.get("progress") == "end",
+    }
 
-            if process.returncode != 0:
-                # 如果是正常结束但有 stderr 输出是正常的，我们需要区分是否真的出错
-                # 通常 returncode != 0 才是真的错
-                raise RuntimeError(f"FFmpeg Error: Return Code {process.returncode}")
-        
-        # 只有未取消且无错误才标记为完成
-        if job.status != "cancelled":
-            job.status = "completed"
-            job.progress = 100.0 # 确保显示完成
-            job.completed_at = datetime.now().timestamp()
-            
-            # 计算输出大小和压缩率
-            try:
-                # 假设只有一个输出文件（因为我们拆分了任务）
-                if job.outputs:
-                    out_p = Path(job.outputs[0])
-                    if out_p.exists():
-                        job.output_size = out_p.stat().st_size
-                        
+def apply_progress(job: JobStatus, stats: Dict[str, Any], max_progress: float = 100.0):
+    """把解析后的进度写入 JobStatus 并通知推送通道"""
+    job.fps = stats["fps"]
+    job.speed = stats["speed"]
+    job.bitrate_kbps = stats["bitrate_kbps"]
+    if stats["size"] is not None:
+        job.current_size = stats["size"]
+
+    current_seconds = stats["seconds"]
+    if current_seconds is not None and job.duration and job.duration > 0:
+        job.progress = min(max_progress, (current_seconds / job.duration) * 100)
+        if job.speed:
+            job.eta = max(0.0, (job.duration - current_seconds) / job.speed)
+        BATCHES.progress(job, current_seconds)
+    JOB_EVENTS.touch(job, state=False)
+
+def scale_progress(stats: Dict[str, Any], offset: float, scale: float) -> Dict[str, Any]:
+    """把一遍编码的进度映射到整个任务中：两遍编码时每遍占一半 (scale=0.5)"""
+    if scale != 1.0 or offset:
+        if stats["seconds"] is not None:
+            stats["seconds"] = offset + stats["seconds"] * scale
+        if stats["speed"]:
+            stats["speed"] *= scale
+    return stats
+
+class ProgressReporter:
+    """将 ffmpeg -progress 输出的键值块按节流间隔写入 JobStatus"""
+
+    def __init__(self, job: JobStatus, interval: float = PROGRESS_UPDATE_INTERVAL, offset: float = 0.0, scale: float = 1.0):
+        self.job = job
+        self.interval = interval
+        self.offset = offset
+        self.scale = scale
+        self._last = 0.0
+
+    def __call__(self, block: Dict[str, str]):
+        now = time.monotonic()
+        if block.get("progress") != "end" and now - self._last < self.interval:
+            return
+        self._last = now
+        apply_progress(self.job, scale_progress(parse_progress_block(block), self.offset, self.scale))
+
+class SegmentedProgress:
+    """汇总多个分段 ffmpeg 进程的进度，按节流间隔写入同一个 JobStatus"""
+
+    def __init__(self, job: JobStatus, count: int, interval: float = PROGRESS_UPDATE_INTERVAL):
+        self.job = job
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stats: List[Dict[str, Any]] = [{} for _ in range(count)]
+        self._last = 0.0
+
+    def reporter(self, index: int, offset: float = 0.0, scale: float = 1.0):
+        return lambda block: self._update(index, scale_progress(parse_progress_block(block), offset, scale))
+
+    def seconds(self, index: int) -> float:
+        """该分段已计入的时长"""
+        with self._lock:
+            return self._stats[index].get("seconds") or 0.0
+
+    def _update(self, index: int, stats: Dict[str, Any]):
+        with self._lock:
+            self._stats[index] = stats
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            # 已结束的分段只计入时长和大小，fps/速度只累加仍在编码的分段
+            active = [st for st in self._stats if st and not st["end"]]
+            seconds = sum(st.get("seconds") or 0.0 for st in self._stats if st)
+            size = sum(st.get("size") or 0 for st in self._stats if st)
+            stats = {
+                "seconds": seconds,
+                "fps": sum(st["fps"] or 0.0 for st in active) or None,
+                "speed": sum(st["speed"] or 0.0 for st in active) or None,
+                "bitrate_kbps": size * 8 / seconds / 1000 if seconds > 0 else None,
+                "size": size,
+            }
+            # 最后的合并封装还没完成，进度停在 99%
+            apply_progress(self.job, stats, max_progress=99.0)
+
+def run_ffmpeg_process(cmd: List[str], job_id: str, on_progress=None) -> Tuple[int, str]:
+    """运行 ffmpeg 进程
+
+    命令带 -progress pipe:1 时，每读到一个完整的进度块 (以 progress=continue/end 结尾)
+    调用一次 on_progress，返回 (退出码, stderr 末尾几行)。
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8", errors="replace")
+    # 存储进程对象
+    with JOB_PROCESSES_LOCK:
+        JOB_PROCESSES.setdefault(job_id, []).append(process)
+
+    # stderr 在后台线程中读取，只保留末尾用于错误信息，避免管道写满阻塞 ffmpeg
+    stderr_tail = deque(maxlen=5)
+    drain = threading.Thread(target=lambda: stderr_tail.extend(process.stderr), daemon=True)
+    drain.start()
+
+    block: Dict[str, str] = {}
+    try:
+        for line in process.stdout:
+            key, sep, value = line.partition("=")
+            if not sep:
+                continue
+            block[key] = value.strip()
+            if key == "progress":
+                if on_progress is not None:
+                    on_progress(block)
+                block = {}
+        process.wait()
+        drain.join()
+    finally:
+        # 清理进程引用
+        with JOB_PROCESSES_LOCK:
+            processes = JOB_PROCESSES.get(job_id, [])
+            if process in processes:
+                processes.remove(process)
+            if not processes:
+                JOB_PROCESSES.pop(job_id, None)
+    return process.returncode, "".join(stderr_tail)
+
+# --- 目标大小 (两遍编码) ---
+PASSLOG_DIR = DATA_DIR / "passlogs"
+# 容器封装开销按目标大小的 1% 预留
+TARGET_SIZE_OVERHEAD = 0.01
+DEFAULT_AUDIO_BITRATE = 128000
+MIN_TARGET_VIDEO_BITRATE = 32000
+# 支持 -pass 的 CPU 编码器；libx265 通过 -x265-params 传递
+TWO_PASS_ENCODERS = {"libx264", "libvpx", "libvpx-vp9", "libaom-av1", "libx265"}
+
+def parse_size(value: Optional[str]) -> Optional[int]:
+    """把 4G / 700M / 4GB / 1500000000 这样的大小解析为字节数 (1K = 1024)"""
+    if not value:
+        return None
+    m = re.fullmatch(r"\s*([\d.]+)\s*([kKmMgGtT]?)[iI]?[bB]?\s*", str(value))
+    if not m:
+        return None
+    return int(float(m[1]) * 1024 ** ("kmgt".index(m[2].lower()) + 1 if m[2] else 0))
+
+def target_bitrates(params: TranscodeParams, info: Optional[Dict[str, Any]], duration: Optional[float],
+                    plan: Optional[Dict[str, Any]]) -> Tuple[int, int]:
+    """target_size 模式：由目标大小、时长和音频码率算出视频码率，返回 (视频 bit/s, 音频 bit/s)
+
+    复制的音频按源码率计算，重新编码的音频按 audio_bitrate (默认 128k) 计算。
+    """
+    target = parse_size(params.target_size)
+    if not target or not duration:
+        raise RuntimeError("无法计算目标码率：缺少目标大小或视频时长")
+    actions = {s["index"]: s["action"] for s in (plan or {}).get("streams", [])}
+    requested_audio = parse_bitrate(params.audio_bitrate) or DEFAULT_AUDIO_BITRATE
+    audio = 0
+    for stream in (info or {}).get("streams", []):
+        if stream.get("codec_type") != "audio" or actions.get(stream.get("index")) == "drop":
+            continue
+        if actions.get(stream.get("index")) == "copy" and stream.get("bit_rate"):
+            audio += int(stream["bit_rate"])
+        else:
+            audio += requested_audio
+    video = int(target * 8 * (1 - TARGET_SIZE_OVERHEAD) / duration) - audio
+    if video < MIN_TARGET_VIDEO_BITRATE:
+        raise RuntimeError(f"目标大小过小：扣除音频后视频码率只有 {max(0, video) // 1000} kb/s")
+    return video, audio
+
+def plan_job(info: Optional[Dict[str, Any]], params: TranscodeParams, duration: Optional[float]) -> Optional[Dict[str, Any]]:
+    """规划各流；target_size 模式下先按目标大小换算视频码率 (会改写 params 的 bitrate/crf)
+
+    先按原参数规划得到音频的复制/编码决定，换算码率后再重新规划，源码率已足够低时视频仍可直接复制。
+    """
+    plan = plan_streams(info, params)
+    if params.target_size:
+        video_bps, _ = target_bitrates(params, info, duration, plan)
+        params.bitrate = f"{video_bps // 1000}k"
+        params.crf = None
+        plan = plan_streams(info, params)
+    return plan
+
+def supports_two_pass(params: TranscodeParams) -> bool:
+    return (not params.hw_accel or params.hw_accel == "cpu") and params.vcodec in TWO_PASS_ENCODERS
+
+def pass_options(params: TranscodeParams, prefix: Path, pass_no: int) -> List[str]:
+    if params.vcodec == "libx265":
+        return ["-x265-params", f"pass={pass_no}:stats={prefix}.x265"]
+    return ["-pass", str(pass_no), "-passlogfile", str(prefix)]
+
+def passlog_prefix(inp: Path, params: TranscodeParams, suffix: str = "") -> Path:
+    """第一遍日志的缓存路径
+
+    第一遍只分析画面复杂度，与目标码率无关，所以同一输入、相同画面参数的任务
+    (例如同一部片子的不同目标大小) 可以直接复用已有日志，只跑第二遍。
+    """
+    picture = params.model_dump(include={"vcodec", "preset", "resolution", "deinterlace", "rotation", "extra_args"})
+    raw = json.dumps([content_fingerprint(inp) or str(inp), picture, suffix], sort_keys=True)
+    PASSLOG_DIR.mkdir(parents=True, exist_ok=True)
+    return PASSLOG_DIR / hashlib.sha256(raw.encode('utf-8')).hexdigest()[:24]
+
+def passlog_ready(prefix: Path) -> bool:
+    return prefix.with_name(prefix.name + ".done").exists()
+
+_passlog_locks: Dict[str, threading.Lock] = {}
+_passlog_locks_lock = threading.Lock()
+
+def run_first_pass(job: JobStatus, inp: Path, params: TranscodeParams, prefix: Path,
+                   video_plan: Optional[Dict[str, Any]], on_progress=None) -> Tuple[int, str]:
+    """执行第一遍编码 (输出丢弃)，日志已存在时直接返回；同一日志同时只有一个进程在写"""
+    with _passlog_locks_lock:
+        lock = _passlog_locks.setdefault(prefix.name, threading.Lock())
+    with lock:
+        done = prefix.with_name(prefix.name + ".done")
+        if done.exists():
+            os.utime(done)
+            return 0, ""
+        first = params.model_copy(update={
+            "extra_args": (params.extra_args or []) + pass_options(params, prefix, 1) + ["-an", "-sn", "-dn", "-f", "null"],
+        })
+        cmd = with_progress_pipe(build_ffmpeg_cmd(inp, Path(os.devnull), first, plan=video_plan))
+        returncode, stderr_tail = run_ffmpeg_process(cmd, job.id, on_progress)
+        if returncode == 0 and job.status != "cancelled":
+            done.touch()
+        return returncode, stderr_tail
+
+def video_only_plan(plan: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """只保留要编码的第一个视频流，用于第一遍"""
+    if plan is None:
+        return None
+    for s in plan["streams"]:
+        if s["type"] == "video" and s["action"] == "encode":
+            return {"mode": "transcode", "streams": [s]}
+    return None
+
+# 可以原样用于只复制视频的封装步骤的 extra_args 选项 (均带一个参数)
+CONTAINER_OPTIONS = {"-movflags", "-metadata", "-brand", "-fflags"}
+
+def container_options(extra_args: Optional[List[str]]) -> List[str]:
+    """从 extra_args 中挑出容器级选项，编码器/滤镜选项会使流复制失败"""
+    result = []
+    args = extra_args or []
+    i = 0
+    while i < len(args) - 1:
+        if args[i] in CONTAINER_OPTIONS:
+            result.extend(args[i:i + 2])
+            i += 2
+        else:
+            i += 1
+    return result
+
+# 分段并行转码的临时目录
+SEGMENT_DIR = DATA_DIR / "segments"
+# 短于此时长 (秒) 的视频不值得分段
+SEGMENT_MIN_DURATION = float(os.environ.get("SEGMENT_MIN_DURATION", 120))
+
+def can_segment(params: TranscodeParams, duration: Optional[float]) -> bool:
+    """分段模式只用于 CPU 编码且时长足够的视频"""
+    if not params.segments or params.segments < 2:
+        return False
+    if params.hw_accel and params.hw_accel != "cpu":
+        return False
+    if not params.vcodec or params.vcodec == "copy":
+        return False
+    return bool(duration) and duration >= SEGMENT_MIN_DURATION
+
+def run_segmented_transcode(job: JobStatus, inp: Path, output_path: Path, params: TranscodeParams,
+                            two_pass: bool = False, plan: Optional[Dict[str, Any]] = None) -> Tuple[int, str]:
+    """分段并行转码
+
+    1. 按关键帧把视频流无损切成约 params.segments 段
+    2. 每段由独立的 ffmpeg 进程并行编码 (只编码视频)；two_pass 时每段各自先跑第一遍
+    3. 用 concat 无损拼接编码后的视频，并按 plan 从源文件复制/编码/丢弃其余流 (无 plan 时映射全部音频/字幕)
+    返回最后一个失败步骤的 (退出码, stderr 末尾)，成功时退出码为 0。
+    """
+    kept: Optional[List[Dict[str, Any]]] = None
+    video_map = "0:v:0"
+    if plan is not None:
+        # 与 build_ffmpeg_cmd 相同的保留顺序；第一路视频走分段编码，其余流在封装时从源文件映射
+        kept = sorted((s for s in plan["streams"] if s["action"] != "drop"), key=lambda s: s["type"] != "video")
+        if kept and kept[0]["type"] == "video":
+            video_map = f"0:{kept[0]['index']}"
+            kept = kept[1:]
+    work_dir = SEGMENT_DIR / job.id
+    shutil.rmtree(work_dir, ignore_errors=True)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        # 1. 切分 (-c copy，segment 复用器只在关键帧处切开)
+        segment_time = job.duration / params.segments
+        split_cmd = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-i", str(inp),
+            "-map", video_map, "-c", "copy",
+            "-f", "segment", "-segment_time", f"{segment_time:.3f}", "-reset_timestamps", "1",
+            str(work_dir / "chunk_%04d.mkv")
+        ]
+        returncode, stderr_tail = run_ffmpeg_process(split_cmd, job.id)
+        if returncode != 0 or job.status == "cancelled":
+            return returncode, stderr_tail
+        chunks = sorted(work_dir.glob("chunk_*.mkv"))
+        encoded = [work_dir / f"enc_{i:04d}.mkv" for i in range(len(chunks))]
+
+        # 2. 并行编码，每个进程分到一部分 CPU 核心
+        workers = min(params.segments, len(chunks))
+        threads = params.threads if params.threads else max(1, (job.cost_cores or CPU_BUDGET) // workers)
+        chunk_params = params.model_copy(update={
+            "acodec": None,
+            "scodec": "none",
+            "threads": threads,
+            "extra_args": (params.extra_args or []) + ["-an"],
+        })
+        progress = SegmentedProgress(job, len(chunks))
+        errors: List[Tuple[int, str]] = []
+        errors_lock = threading.Lock()
+
+        def fail(result: Tuple[int, str]):
+            with errors_lock:
+                first = not errors
+                errors.append(result)
+            if first:
+                # 一段失败即终止其余分段
+                terminate_job_processes(job.id)
+
+        def encode_chunk(index: int):
+            if errors or job.status == "cancelled":
+                return
+            encode_params, reporter = chunk_params, progress.reporter(index)
+            if two_pass:
+                # 第一遍日志按分段缓存：整片的统计日志无法驱动单个分段的第二遍
+                prefix = passlog_prefix(inp, params, f"seg{params.segments}-{len(chunks)}-{index}")
+                if not passlog_ready(prefix):
+                    result = run_first_pass(job, chunks[index], chunk_params, prefix, None, progress.reporter(index, scale=0.5))
+                    if result[0] != 0:
+                        fail(result)
+                        return
+                    if job.status == "cancelled":
+                        return
+                    reporter = progress.reporter(index, offset=progress.seconds(index), scale=0.5)
+                encode_params = chunk_params.model_copy(update={
+                    "extra_args": chunk_params.extra_args + pass_options(params, prefix, 2),
+                })
+            cmd = with_progress_pipe(build_ffmpeg_cmd(chunks[index], encoded[index], encode_params))
+            result = run_ffmpeg_process(cmd, job.id, reporter)
+            if result[0] != 0:
+                fail(result)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"seg-{job.id[:8]}") as pool:
+            list(pool.map(encode_chunk, range(len(chunks))))
+        if errors:
+            return errors[0]
+        if job.status == "cancelled":
+            return 0, ""
+
+        # 3. 拼接并封装其余流
+        list_file = work_dir / "concat.txt"
+        list_file.write_text("".join(f"file '{p.name}'\n" for p in encoded), encoding="utf-8")
+        mux_cmd = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", str(list_file),
+            "-i", str(inp),
+            "-map", "0:v"
+        ]
+        if kept is not None:
+            # 输出流 0 是拼接好的视频，其余按计划逐流映射 (输出流序号 = kept 中的位置 + 1)
+            for s in kept:
+                mux_cmd.extend(["-map", f"1:{s['index']}"])
+            mux_cmd.extend(["-map_metadata", "1", "-map_chapters", "1", "-c:0", "copy"])
+            for out_idx, s in enumerate(kept, start=1):
+                if s["action"] == "copy":
+                    mux_cmd.extend([f"-c:{out_idx}", "copy"])
+                elif s["type"] == "video":
+                    mux_cmd.extend([f"-c:{out_idx}", params.vcodec])
+                elif s["encoder"]:
+                    mux_cmd.extend([f"-c:{out_idx}", s["encoder"]])
+            if params.audio_bitrate and any(s["type"] == "audio" and s["action"] == "encode" for s in kept):
+                mux_cmd.extend(["-b:a", params.audio_bitrate])
+        else:
+            mux_cmd.extend(["-map", "1:a?", "-map", "1:s?", "-map_metadata", "1", "-map_chapters", "1", "-c:v", "copy"])
+            if params.acodec:
+                mux_cmd.extend(["-c:a", params.acodec])
+            if params.audio_bitrate:
+                mux_cmd.extend(["-b:a", params.audio_bitrate])
+            if params.scodec and params.scodec.lower() != "none":
+                mux_cmd.extend(["-c:s", params.scodec])
+            else:
+                mux_cmd.extend(["-sn"])
+        # extra_args 已用于每段编码；封装只复制视频，只带上容器级选项
+        mux_cmd.extend(container_options(params.extra_args))
+        mux_cmd.append(str(output_path))
+        return run_ffmpeg_process(mux_cmd, job.id)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def _file_identity(path: Path) -> Optional[tuple]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def discard_partial_output(path: Path, before: Optional[tuple]):
+    """删除失败/取消的任务写了一半的输出文件
+
+    before 为开始编码前同名文件的 (inode, 大小, mtime)；文件没有被本任务改动过
+    (例如 ffmpeg 还没打开输出就失败了) 时保留，避免误删其他任务的成品。
+    """
+    current = _file_identity(path)
+    if current is None or current == before:
+        return
+    try:
+        path.unlink()
+    except OSError:
+        return
+    JANITOR.record("outputs", 1, current[1])
+
+def run_transcode_job(job_id: str):
+    job = JOB_STORE.get(job_id)
+    # 本任务正在写入的输出及其写入前的状态，失败或取消时删除
+    writing: Optional[Path] = None
+    writing_before: Optional[tuple] = None
+    try:
+        # 简单实现：顺序处理所有输入文件
+        for idx, input_file in enumerate(job.inputs):
+            # 检查任务是否已被取消
+            if job.status == "cancelled":
+                break
+
+            inp = Path(input_file)
+            if not inp.exists():
+                raise FileNotFoundError(f"输入文件不存在: {inp}")
+            
+            # 确定输出路径
+            suffix = f".{job.params.get('format', 'mp4')}"
+            out_name = inp.stem + suffix
+            # 如果指定了输出目录则使用，否则默认
+            if job.outputs and len(job.outputs) > idx:
+                 # 此时 outputs 已经在创建任务时预填充了，这里确认一下
+                 pass
+            
+            # 这里简单起见，重新计算输出路径以确保正确
+            out_dir = OUTPUT_DIR
+            if job.outputs and len(job.outputs) > 0:
+                 out_dir = Path(job.outputs[0]).parent
+            
+            output_path = out_dir / out_name
+            
+            # 相同内容 + 相同参数已经转码过：直接复用已有输出，不再重新编码
+            # 指纹在这里按当前文件重新计算 (文件可能在创建任务后被替换，重试的任务也会走到这里)，
+            # 随任务状态一起保存，保证已完成任务的指纹对应它实际编码的内容
+            job.dedup_key = dedup_key(inp, TranscodeParams(**job.params))
+            JOB_STORE.save(job)
+            source = JOB_STORE.find_completed(job.dedup_key, job.id) if job.dedup_key else None
+            if source is not None and reuse_output(Path(source.outputs[0]), output_path):
+                job.reused_from = source.id
+                job.command = f"[reuse {source.id}] {source.outputs[0]}"
+                continue
+            
+            # 已有输出可能是复用时创建的硬链接：先断开，避免覆盖写入同时破坏另一份输出
+            try:
+                if output_path.stat().st_nlink > 1:
+                    output_path.unlink()
+            except OSError:
+                pass
+            writing, writing_before = output_path, _file_identity(output_path)
+            
+            # 构建参数对象
+            params_obj = TranscodeParams(**job.params)
+            # 按当前的探测结果重新规划各流 (文件可能在创建任务后被替换)
+            job.plan = plan_job(probe_media(inp), params_obj, job.duration)
+            # 目标大小模式用两遍编码；硬件编码器不支持两遍，退化为单遍平均码率
+            two_pass = bool(params_obj.target_size) and plan_encodes_video(job.plan) and supports_two_pass(params_obj)
+            segmented = plan_encodes_video(job.plan) and can_segment(params_obj, job.duration)
+            if not params_obj.threads and job.cost_cores and not segmented:
+                # 按调度时分配的核数限制线程，避免并发任务互相争抢
+                params_obj.threads = job.cost_cores
+            cmd = build_ffmpeg_cmd(inp, output_path, params_obj, plan=job.plan)
+            
+            # 更新任务信息中的命令（仅记录最后一条）
+            job.command = " ".join(cmd)
+            
+            if segmented:
+                # 大文件: 分段并行编码后拼接
+                job.command = f"[segments={params_obj.segments}] " + job.command
+                returncode, stderr_tail = run_segmented_transcode(job, inp, output_path, params_obj, two_pass, job.plan)
+            elif two_pass:
+                # 两遍编码：第一遍只分析视频 (日志可复用)，第二遍按日志分配码率
+                prefix = passlog_prefix(inp, params_obj)
+                half = (job.duration or 0) / 2 if not passlog_ready(prefix) else 0.0
+                returncode, stderr_tail = run_first_pass(
+                    job, inp, params_obj, prefix, video_only_plan(job.plan), ProgressReporter(job, scale=0.5))
+                if returncode == 0 and job.status != "cancelled":
+                    second = params_obj.model_copy(update={
+                        "extra_args": (params_obj.extra_args or []) + pass_options(params_obj, prefix, 2),
+                    })
+                    cmd = build_ffmpeg_cmd(inp, output_path, second, plan=job.plan)
+                    job.command = "[2-pass] " + " ".join(cmd)
+                    returncode, stderr_tail = run_ffmpeg_process(
+                        with_progress_pipe(cmd), job_id, ProgressReporter(job, offset=half, scale=0.5 if half else 1.0))
+            else:
+                # 执行命令，通过 -progress pipe:1 读取机器可读的进度
+                returncode, stderr_tail = run_ffmpeg_process(with_progress_pipe(cmd), job_id, ProgressReporter(job))
+            
+            # 再次检查状态
+            if job.status == "cancelled":
+                break
+
+            if returncode != 0:
+                # 如果是正常结束但有 stderr 输出是正常的，我们需要区分是否真的出错
+                # 通常 returncode != 0 才是真的错
+                raise RuntimeError(f"FFmpeg Error: Return Code {returncode}\n{stderr_tail}".rstrip())
+        
+        # 只有未取消且无错误才标记为完成
+        if job.status != "cancelled":
+            job.status = "completed"
+            job.progress = 100.0 # 确保显示完成
+            job.eta = 0.0
+            job.completed_at = datetime.now().timestamp()
+            
+            # 计算输出大小和压缩率
+            try:
+                # 假设只有一个输出文件（因为我们拆分了任务）
+                if job.outputs:
+                    out_p = Path(job.outputs[0])
+                    if out_p.exists():
+                        job.output_size = out_p.stat().st_size
+                        
                         if job.input_size and job.input_size > 0:
                             # 压缩率 = 输出 / 输入 (例如 0.5 表示 50%)
                             # 或者用户想要的可能是压缩比例 (Saved space?)
@@ -470,27 +2189,43 @@ def run_transcode_job(job_id: str):
                             # 或者 Compression Ratio 2:1 etc.
                             # 这里存储小数比率，前端去格式化
                             job.compression_ratio = job.output_size / job.input_size
+                        if job.target_bytes:
+                            job.target_deviation = job.output_size / job.target_bytes - 1
             except Exception as e:
                 print(f"Error calculating stats: {e}")
+            JOB_STORE.save(job)
                 
     except Exception as e:
         # 如果是取消导致的错误，不标记为失败
         if job.status != "cancelled":
             job.status = "failed"
             job.error = str(e)
+            JOB_STORE.save(job)
+    if writing is not None and job.status in ("failed", "cancelled"):
+        discard_partial_output(writing, writing_before)
 
 # --- Auth Endpoints ---
 
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    users_db = load_users()
+async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    throttle_key = f"{form_data.username}@{client_address(request)}"
+    retry_after = LOGIN_THROTTLE.retry_after(throttle_key)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="登录尝试过于频繁，请稍后再试",
+            headers={"Retry-After": str(max(1, int(retry_after)))},
+        )
+    users_db = get_cached_users()
     user_data = users_db.get(form_data.username)
-    if not user_data or not verify_password(form_data.password, user_data["hashed_password"]):
+    if not user_data or not await run_blocking(verify_password, form_data.password, user_data["hashed_password"]):
+        LOGIN_THROTTLE.record_failure(throttle_key)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    LOGIN_THROTTLE.reset(throttle_key)
     user = UserInDB(**user_data)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -500,7 +2235,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @app.get("/auth/setup-required")
 def is_setup_required():
-    users = load_users()
+    users = get_cached_users()
     return {"setup_required": len(users) == 0}
 
 @app.post("/auth/setup")
@@ -544,11 +2279,11 @@ async def change_password(
     current_user: User = Depends(get_current_user)
 ):
     users_db = load_users()
-    if not verify_password(password_data.old_password, users_db[current_user.username]["hashed_password"]):
+    if not await run_blocking(verify_password, password_data.old_password, users_db[current_user.username]["hashed_password"]):
         raise HTTPException(status_code=400, detail="Old password incorrect")
     
-    users_db[current_user.username]["hashed_password"] = get_password_hash(password_data.new_password)
-    save_users(users_db)
+    users_db[current_user.username]["hashed_password"] = await run_blocking(get_password_hash, password_data.new_password)
+    await run_blocking(save_users, users_db)
     return {"message": "Password updated successfully"}
 
 @app.post("/users")
@@ -563,60 +2298,215 @@ async def create_new_user(
     if new_user.username in users_db:
         raise HTTPException(status_code=400, detail="Username already registered")
         
+    hashed = await run_blocking(get_password_hash, new_user.password)
+    # 哈希期间其他请求可能已修改用户表，重新读取
+    users_db = load_users()
+    if new_user.username in users_db:
+        raise HTTPException(status_code=400, detail="Username already registered")
+        
     users_db[new_user.username] = {
         "username": new_user.username,
-        "hashed_password": get_password_hash(new_user.password),
+        "hashed_password": hashed,
         "disabled": False
     }
-    save_users(users_db)
+    await run_blocking(save_users, users_db)
     return {"username": new_user.username}
 
 # --- API Interfaces ---
 
+def generate_thumbnail(p: Path, thumb_path: Path):
+    """Generate a thumbnail using ffmpeg (blocking)."""
+    try:
+        cmd = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-ss", "00:00:05", # Try to take frame at 5s
+            "-i", str(p),
+            "-vframes", "1",
+            "-q:v", "2",
+            "-vf", "scale=320:-1", # Resize width to 320px, keep aspect ratio
+            str(thumb_path)
+        ]
+        # If video is shorter than 5s, try 0s
+        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        
+        if not thumb_path.exists():
+             # Retry at 0s if 5s failed (maybe video is short)
+            cmd[6] = "00:00:00"
+            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            
+    except Exception as e:
+        print(f"Thumbnail generation failed: {e}")
+
+THUMBNAIL_DIR = DATA_DIR / "thumbnails"
+THUMBNAIL_CACHE_MB = int(os.environ.get("THUMBNAIL_CACHE_MB", 512))
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+
+class ThumbnailCache:
+    """Disk cache of video thumbnails.
+
+    Keys include the file size and mtime, so a replaced file gets a fresh
+    thumbnail. Concurrent requests for the same file share one ffmpeg run,
+    and the directory is kept under a size quota by evicting the least
+    recently used files (mtime is refreshed on hits).
+    """
+
+    # Refresh the mtime of a hit at most this often (seconds)
+    TOUCH_INTERVAL = 3600
+
+    def __init__(self, directory: Path, quota_bytes: int, workers: int):
+        self.dir = directory
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.quota = quota_bytes
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumb")
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+        self._total: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, p: Path, st: os.stat_result) -> Path:
+        key = hashlib.md5(f"{p}|{st.st_size}|{st.st_mtime_ns}".encode('utf-8')).hexdigest()
+        return self.dir / f"{key}.jpg"
+
+    def get(self, p: Path) -> Future:
+        """Return a future resolving to the thumbnail path, or None if it cannot be generated."""
+        thumb = self.path_for(p, p.stat())
+        with self._lock:
+            if thumb.exists():
+                self.hits += 1
+                self._touch(thumb)
+                fut = Future()
+                fut.set_result(thumb)
+                return fut
+            fut = self._inflight.get(thumb.name)
+            if fut is None:
+                self.misses += 1
+                fut = self._executor.submit(self._generate, p, thumb)
+                self._inflight[thumb.name] = fut
+            return fut
+
+    def _touch(self, thumb: Path):
+        try:
+            if time.time() - thumb.stat().st_mtime > self.TOUCH_INTERVAL:
+                os.utime(thumb)
+        except OSError:
+            pass
+
+    def _generate(self, p: Path, thumb: Path) -> Optional[Path]:
+        # Write to a temporary name so readers never see a half-written file
+        tmp = thumb.with_name(f"{thumb.stem}.tmp.jpg")
+        try:
+            started = time.monotonic()
+            generate_thumbnail(p, tmp)
+            THUMBNAIL_SECONDS.observe(time.monotonic() - started)
+            if not tmp.exists():
+                return None
+            size = tmp.stat().st_size
+            os.replace(tmp, thumb)
+            with self._lock:
+                if self._total is not None:
+                    self._total += size
+                self._enforce_quota(keep=thumb.name)
+            return thumb
+        finally:
+            tmp.unlink(missing_ok=True)
+            with self._lock:
+                self._inflight.pop(thumb.name, None)
+
+    def prune(self, max_age: Optional[float]) -> Tuple[int, int, int]:
+        """Evict thumbnails older than max_age, then enforce the quota.
+
+        Returns (files removed, bytes removed, bytes remaining).
+        """
+        with self._lock:
+            entries = []
+            for e in os.scandir(self.dir):
+                if e.is_file() and not e.name.endswith(".tmp.jpg"):
+                    st = e.stat()
+                    entries.append((st.st_mtime, st.st_size, [e.path]))
+            files, size, self._total = evict_lru(entries, self.quota, max_age)
+            return files, size, self._total
+
+    def _enforce_quota(self, keep: Optional[str] = None):
+        if self._total is None:
+            self._total = sum(e.stat().st_size for e in os.scandir(self.dir) if e.is_file())
+        if self._total <= self.quota:
+            return
+        # Evict the oldest files until we are at 90% of the quota
+        entries = sorted(
+            (e for e in os.scandir(self.dir) if e.is_file() and e.name != keep and not e.name.endswith(".tmp.jpg")),
+            key=lambda e: e.stat().st_mtime,
+        )
+        for entry in entries:
+            if self._total <= self.quota * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.unlink(entry.path)
+                self._total -= size
+            except OSError:
+                pass
+
+THUMBNAILS = ThumbnailCache(THUMBNAIL_DIR, THUMBNAIL_CACHE_MB * 1024 * 1024, THUMBNAIL_WORKERS)
+
 @app.get("/thumbnail")
 async def get_thumbnail(path: str):
     """Generate or retrieve a thumbnail for a video file."""
     p = Path(path)
-    if not p.exists():
+    if not p.is_file():
         raise HTTPException(status_code=404, detail="File not found")
         
-    # Thumbnails cache directory
-    thumb_dir = DATA_DIR / "thumbnails"
-    thumb_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Hash path to get unique filename
-    path_hash = hashlib.md5(str(p).encode('utf-8')).hexdigest()
-    thumb_path = thumb_dir / f"{path_hash}.jpg"
-    
-    if not thumb_path.exists():
-        # Generate thumbnail using ffmpeg
-        try:
-            cmd = [
-                "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
-                "-ss", "00:00:05", # Try to take frame at 5s
-                "-i", str(p),
-                "-vframes", "1",
-                "-q:v", "2",
-                "-vf", "scale=320:-1", # Resize width to 320px, keep aspect ratio
-                str(thumb_path)
-            ]
-            # If video is shorter than 5s, try 0s
-            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            if not thumb_path.exists():
-                 # Retry at 0s if 5s failed (maybe video is short)
-                cmd[6] = "00:00:00"
-                subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                
-        except Exception as e:
-            print(f"Thumbnail generation failed: {e}")
-            
-    if thumb_path.exists():
+    thumb_path = await asyncio.wrap_future(THUMBNAILS.get(p))
+    if thumb_path is not None:
         return FileResponse(thumb_path)
     
     # Return a default placeholder or 404
     raise HTTPException(status_code=404, detail="Thumbnail could not be generated")
 
+# Background thumbnail pre-generation tasks: task_id -> progress
+# Keep at most this many pregenerate tasks; the oldest finished ones are evicted first.
+THUMBNAIL_TASKS_MAX = 64
+THUMBNAIL_TASKS: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_thumbnail_tasks_lock = threading.Lock()
+
+def pregenerate_thumbnails_task(task: Dict[str, Any]):
+    """Walk a directory and generate missing thumbnails one at a time,
+    leaving the other thumbnail workers free for interactive requests."""
+    files = []
+    for root, _, names in os.walk(task["path"]):
+        files.extend(os.path.join(root, n) for n in names if Path(n).suffix.lower() in ALLOWED_EXTS)
+    task["total"] = len(files)
+    for fpath in files:
+        try:
+            if THUMBNAILS.get(Path(fpath)).result() is None:
+                task["failed"] += 1
+        except Exception:
+            task["failed"] += 1
+        task["done"] += 1
+    task["status"] = "completed"
+
+@app.post("/thumbnails/pregenerate")
+def pregenerate_thumbnails(path: str = Form(...), current_user: User = Depends(get_current_user)):
+    """Pre-generate thumbnails for every video under a directory in the background."""
+    base_path = Path(path)
+    if not base_path.is_dir():
+        raise HTTPException(status_code=400, detail="该路径不是目录")
+    task = {"id": uuid.uuid4().hex, "path": str(base_path), "status": "running", "total": None, "done": 0, "failed": 0}
+    with _thumbnail_tasks_lock:
+        THUMBNAIL_TASKS[task["id"]] = task
+        finished = [tid for tid, t in THUMBNAIL_TASKS.items() if t["status"] != "running"]
+        for tid in finished[:max(0, len(THUMBNAIL_TASKS) - THUMBNAIL_TASKS_MAX)]:
+            del THUMBNAIL_TASKS[tid]
+    threading.Thread(target=pregenerate_thumbnails_task, args=(task,), name="thumb-pregen", daemon=True).start()
+    return task
+
+@app.get("/thumbnails/pregenerate/{task_id}")
+def get_pregenerate_status(task_id: str, current_user: User = Depends(get_current_user)):
+    task = THUMBNAIL_TASKS.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return task
+
 class FileInfo(BaseModel):
     path: str
     exists: bool
@@ -628,45 +2518,164 @@ class FileInfo(BaseModel):
 class BatchFileRequest(BaseModel):
     files: List[str]
 
+# 文件信息探测线程池 (ffprobe 为阻塞调用，不能在事件循环中执行)
+PROBE_WORKERS = int(os.environ.get("PROBE_WORKERS", min(8, os.cpu_count() or 4)))
+PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+
+def build_file_info(fpath: str) -> FileInfo:
+    """收集单个文件的大小和时长 (阻塞)"""
+    p = Path(fpath)
+    info = FileInfo(path=fpath, exists=p.exists())
+    if p.exists() and p.is_file():
+        try:
+            st = p.stat()
+            size = float(st.st_size)
+            # Format size
+            for unit in ['B', 'KB', 'MB', 'GB']:
+                if size < 1024.0:
+                    info.size_fmt = f"{size:.2f} {unit}"
+                    break
+                size /= 1024.0
+            else:
+                info.size_fmt = f"{size:.2f} TB"
+            
+            info.size = st.st_size
+            
+            info.duration = get_video_duration(p)
+            m, s = divmod(int(info.duration), 60)
+            h, m = divmod(m, 60)
+            info.duration_fmt = f"{h:02d}:{m:02d}:{s:02d}"
+        except:
+            pass
+    return info
+
 @app.post("/files/batch-info", response_model=List[FileInfo])
 async def get_batch_file_info(req: BatchFileRequest, current_user: User = Depends(get_current_user)):
-    results = []
-    for fpath in req.files:
-        p = Path(fpath)
-        info = FileInfo(path=fpath, exists=p.exists())
-        if p.exists() and p.is_file():
-            try:
-                st = p.stat()
-                info.size = st.st_size
-                # Format size
-                for unit in ['B', 'KB', 'MB', 'GB']:
-                    if info.size < 1024.0:
-                        info.size_fmt = f"{info.size:.2f} {unit}"
-                        break
-                    info.size /= 1024.0
-                else:
-                    info.size_fmt = f"{info.size:.2f} TB"
-                
-                # Restore raw size for sorting if needed
-                info.size = st.st_size
-                
-                info.duration = get_video_duration(p)
-                m, s = divmod(int(info.duration), 60)
-                h, m = divmod(m, 60)
-                info.duration_fmt = f"{h:02d}:{m:02d}:{s:02d}"
-            except:
-                pass
-        results.append(info)
-    return results
+    loop = asyncio.get_running_loop()
+    tasks = [loop.run_in_executor(PROBE_EXECUTOR, build_file_info, fpath) for fpath in req.files]
+    return await asyncio.gather(*tasks)
+
+@app.post("/files/batch-info/stream")
+async def stream_batch_file_info(req: BatchFileRequest, current_user: User = Depends(get_current_user)):
+    """与 /files/batch-info 相同，但以 NDJSON 逐条返回，每个文件探测完成即输出一行"""
+    loop = asyncio.get_running_loop()
+    tasks = [loop.run_in_executor(PROBE_EXECUTOR, build_file_info, fpath) for fpath in req.files]
+
+    async def generate():
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                info = await next_done
+                yield info.model_dump_json() + "\n"
+        finally:
+            # 客户端断开时取消尚未开始的探测
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 @app.get("/")
 def read_root():
     return FileResponse(STATIC_DIR / "index.html")
 
 @app.get("/jobs")
-def get_jobs(current_user: User = Depends(get_current_user)):
-    # 按时间倒序返回
-    return list(reversed(list(JOBS.values())))
+def get_jobs(
+    request: Request,
+    response: Response,
+    status_filter: Optional[str] = Query(None, alias="status"),
+    page: int = Query(1, ge=1),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    since: Optional[int] = None,
+    batch_id: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+):
+    """查询任务列表 (按时间倒序)
+
+    - status: 逗号分隔的状态过滤，例如 pending,running
+    - batch_id: 只返回该批次的任务
+    - page / limit: 分页，不指定 limit 时返回全部
+    - since: 只返回修订号大于该值的任务，新的游标在 X-Jobs-Revision 响应头中；
+      期间有任务被删除或 since 过旧时带 X-Jobs-Reset: 1，客户端应去掉 since 全量获取
+    任何任务变化都会改变修订号；If-None-Match 与当前 ETag 相同时返回 304。
+    """
+    # 先取修订号再取列表，之后的变化都会通过 /jobs/events 推送
+    revision = JOB_EVENTS.revision
+    query_key = f"{status_filter}|{page}|{limit}|{since}|{batch_id}"
+    etag = f'W/"{revision}-{hashlib.md5(query_key.encode("utf-8")).hexdigest()[:8]}"'
+    headers = {"ETag": etag, "X-Jobs-Revision": str(revision)}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if since is not None:
+        # 删除的任务不在 jobs 表里，增量结果无法表达
+        _, changes = JOB_EVENTS.changes_since(since)
+        if changes is None or any(removed for _, _, removed in changes):
+            headers["X-Jobs-Reset"] = "1"
+
+    statuses = [s.strip() for s in status_filter.split(",") if s.strip()] if status_filter else None
+    offset = (page - 1) * limit if limit else 0
+    total, jobs = JOB_STORE.query(statuses, since, limit, offset, batch_id)
+
+    response.headers.update(headers)
+    response.headers["X-Total-Count"] = str(total)
+    return jobs
+
+# 进度推送只包含这些字段，状态变化时推送完整任务
+PROGRESS_FIELDS = ("id", "status", "progress", "fps", "speed", "bitrate_kbps", "current_size", "eta", "revision")
+
+def build_job_delta(changes: List[Tuple[str, bool, bool]]) -> Dict[str, list]:
+    """变化任务的增量，附带这些任务所属批次的最新汇总 (删除任务后批次可能消失，客户端需重新获取 /batches)"""
+    delta = {"jobs": [], "progress": [], "removed": [], "batches": []}
+    batch_ids = set()
+    for job_id, state_changed, removed in changes:
+        job = None if removed else JOB_STORE.get(job_id)
+        if job is None:
+            delta["removed"].append(job_id)
+            continue
+        if state_changed:
+            delta["jobs"].append(job.model_dump())
+        else:
+            delta["progress"].append(job.model_dump(include=set(PROGRESS_FIELDS)))
+        if job.batch_id:
+            batch_ids.add(job.batch_id)
+    for batch_id in batch_ids:
+        batch = BATCHES.get(batch_id)
+        if batch is not None:
+            delta["batches"].append(batch.model_dump())
+    return delta
+
+@app.get("/jobs/events")
+async def job_events(request: Request, since: Optional[int] = None, current_user: User = Depends(get_current_user)):
+    """Server-Sent Events 推送任务变化
+
+    每 JOB_EVENT_INTERVAL 秒最多发送一条 jobs 消息，只包含 since 之后变化的任务；
+    since 过旧 (例如服务已重启) 时发送 reset，客户端应重新获取 /jobs。
+    """
+    async def generate():
+        cursor = since if since is not None else JOB_EVENTS.revision
+        idle = 0.0
+        while not await request.is_disconnected():
+            revision, changes = JOB_EVENTS.changes_since(cursor)
+            if changes is None:
+                yield f"event: reset\ndata: {json.dumps({'revision': revision})}\n\n"
+                cursor = revision
+            elif changes:
+                payload = build_job_delta(changes)
+                payload["revision"] = revision
+                yield f"event: jobs\ndata: {json.dumps(payload)}\n\n"
+                cursor = revision
+                idle = 0.0
+            elif idle >= 15:
+                # 保持连接，防止被反向代理断开
+                yield ": ping\n\n"
+                idle = 0.0
+            await asyncio.sleep(JOB_EVENT_INTERVAL)
+            idle += JOB_EVENT_INTERVAL
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/hardware-info")
 def get_hardware_info(current_user: User = Depends(get_current_user)):
@@ -722,7 +2731,14 @@ def get_hardware_info(current_user: User = Depends(get_current_user)):
 
 @app.get("/settings/concurrency")
 def get_concurrency(current_user: User = Depends(get_current_user)):
-    return {"max_concurrent_jobs": MAX_CONCURRENT_JOBS}
+    return {
+        "max_concurrent_jobs": MAX_CONCURRENT_JOBS,
+        "running_jobs": SCHEDULER.running_count,
+        "cpu_budget": CPU_BUDGET,
+        "cpu_used": SCHEDULER.used_cores,
+        "memory_budget_mb": MEMORY_BUDGET_MB,
+        "memory_used_mb": SCHEDULER.used_memory_mb,
+    }
 
 @app.post("/settings/concurrency")
 def set_concurrency(count: int = Form(...), current_user: User = Depends(get_current_user)):
@@ -731,7 +2747,7 @@ def set_concurrency(count: int = Form(...), current_user: User = Depends(get_cur
         raise HTTPException(status_code=400, detail="并发数必须大于 0")
     MAX_CONCURRENT_JOBS = count
     # 立即尝试启动更多任务
-    try_start_jobs()
+    SCHEDULER.wake()
     return {"max_concurrent_jobs": MAX_CONCURRENT_JOBS}
 
 @app.post("/upload")
@@ -746,282 +2762,1639 @@ async def upload_file(file: UploadFile = File(...), current_user: User = Depends
         
     return {"filename": file.filename, "path": str(file_path)}
 
+# --- 分块上传 (可断点续传) ---
+# 协议: POST /uploads 创建会话 -> PUT /uploads/{id}?offset=N 上传分块 (可并行)
+#       -> GET /uploads/{id} 查询已接收区间 -> POST /uploads/{id}/finalize 校验并落地
+# 分块直接写入 INPUT_DIR/.uploads 下的 .part 文件，完成后原子重命名到 INPUT_DIR
+UPLOAD_DIR = INPUT_DIR / ".uploads"
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+# 请求体累积到这个大小再写盘
+UPLOAD_WRITE_BUFFER = 1024 * 1024
+
+class UploadInit(BaseModel):
+    filename: str
+    size: int = Field(ge=0)
+
+class UploadSession:
+    """一个分块上传会话，元数据保存在 .json 中以便服务重启后继续上传"""
+
+    def __init__(self, upload_id: str, filename: str, size: int, ranges: Optional[List[List[int]]] = None):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        # 已接收的区间 [start, end)，有序且不重叠
+        self.ranges: List[List[int]] = ranges or []
+        self.lock = threading.Lock()
+        # 文件开头连续部分的增量 sha256
+        self._hasher = hashlib.sha256()
+        self._hashed = 0
+
+    @property
+    def part_path(self) -> Path:
+        return UPLOAD_DIR / f"{self.id}.part"
+
+    @property
+    def meta_path(self) -> Path:
+        return UPLOAD_DIR / f"{self.id}.json"
+
+    @classmethod
+    def load(cls, upload_id: str) -> Optional["UploadSession"]:
+        try:
+            meta = json.loads((UPLOAD_DIR / f"{upload_id}.json").read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return cls(upload_id, meta["filename"], meta["size"], meta.get("ranges"))
+
+    def save_meta(self):
+        tmp = self.meta_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"filename": self.filename, "size": self.size, "ranges": self.ranges}), encoding="utf-8")
+        os.replace(tmp, self.meta_path)
+
+    @property
+    def received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def next_offset(self) -> int:
+        """第一个缺失的偏移量，从这里继续上传即可"""
+        return self.ranges[0][1] if self.ranges and self.ranges[0][0] == 0 else 0
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "upload_id": self.id,
+            "filename": self.filename,
+            "size": self.size,
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "received": self.ranges,
+            "received_bytes": self.received,
+            "next_offset": self.next_offset,
+        }
+
+    def write(self, offset: int, data: bytes):
+        """把数据写到 .part 文件的指定位置 (阻塞)"""
+        fd = os.open(self.part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+    def commit(self, start: int, end: int):
+        """分块完整接收后记录区间，并把连续前缀继续计入校验和 (阻塞)"""
+        with self.lock:
+            merged = []
+            for r in sorted(self.ranges + [[start, end]]):
+                if merged and r[0] <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], r[1])
+                else:
+                    merged.append(list(r))
+            self.ranges = merged
+            self.save_meta()
+            self._advance_hash()
+
+    def _advance_hash(self):
+        # 乱序到达的分块会在前面的空洞补齐后从文件读回 (通常仍在页缓存中)
+        target = self.next_offset
+        if target <= self._hashed:
+            return
+        with open(self.part_path, "rb") as f:
+            f.seek(self._hashed)
+            while self._hashed < target:
+                data = f.read(min(UPLOAD_WRITE_BUFFER, target - self._hashed))
+                if not data:
+                    break
+                self._hasher.update(data)
+                self._hashed += len(data)
+
+    def checksum(self) -> str:
+        with self.lock:
+            self._advance_hash()
+            return self._hasher.hexdigest()
+
+UPLOAD_SESSIONS: Dict[str, UploadSession] = {}
+UPLOAD_SESSIONS_LOCK = threading.Lock()
+
+def get_upload_session(upload_id: str) -> UploadSession:
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+        raise HTTPException(status_code=404, detail="上传会话不存在")
+    with UPLOAD_SESSIONS_LOCK:
+        session = UPLOAD_SESSIONS.get(upload_id)
+        if session is None:
+            # 服务重启后从元数据恢复
+            session = UploadSession.load(upload_id)
+            if session is None:
+                raise HTTPException(status_code=404, detail="上传会话不存在")
+            UPLOAD_SESSIONS[upload_id] = session
+        return session
+
+@app.post("/uploads")
+def init_upload(req: UploadInit, current_user: User = Depends(get_current_user)):
+    filename = Path(req.filename).name
+    if Path(filename).suffix.lower() not in ALLOWED_EXTS:
+        raise HTTPException(status_code=400, detail="不支持的文件类型")
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    session = UploadSession(uuid.uuid4().hex, filename, req.size)
+    # 预先创建并设置文件大小，分块可以按任意顺序写入
+    with open(session.part_path, "wb") as f:
+        f.truncate(req.size)
+    session.save_meta()
+    with UPLOAD_SESSIONS_LOCK:
+        UPLOAD_SESSIONS[session.id] = session
+    return session.status()
+
+@app.get("/uploads/{upload_id}")
+def get_upload_status(upload_id: str, current_user: User = Depends(get_current_user)):
+    return get_upload_session(upload_id).status()
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, request: Request, offset: int = Query(..., ge=0), current_user: User = Depends(get_current_user)):
+    """上传一个分块，请求体为原始字节；连接中断时该分块不会被记录，从同一 offset 重传即可"""
+    session = get_upload_session(upload_id)
+    pos = offset
+    buffer = bytearray()
+    async for data in request.stream():
+        buffer += data
+        if pos + len(buffer) > session.size:
+            raise HTTPException(status_code=400, detail="分块超出文件大小")
+        if len(buffer) >= UPLOAD_WRITE_BUFFER:
+            await run_blocking(session.write, pos, bytes(buffer))
+            pos += len(buffer)
+            buffer.clear()
+    if buffer:
+        await run_blocking(session.write, pos, bytes(buffer))
+        pos += len(buffer)
+    if pos > offset:
+        await run_blocking(session.commit, offset, pos)
+    return session.status()
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, sha256: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """所有区间接收完成后校验 sha256 (可选) 并移动到 INPUT_DIR"""
+    session = get_upload_session(upload_id)
+    if session.next_offset < session.size:
+        raise HTTPException(status_code=400, detail=f"上传未完成，缺少偏移 {session.next_offset} 之后的数据")
+    checksum = await run_blocking(session.checksum)
+    if sha256 and sha256.lower() != checksum:
+        raise HTTPException(status_code=400, detail="校验和不匹配")
+    file_path = INPUT_DIR / session.filename
+    os.replace(session.part_path, file_path)
+    session.meta_path.unlink(missing_ok=True)
+    with UPLOAD_SESSIONS_LOCK:
+        UPLOAD_SESSIONS.pop(upload_id, None)
+    return {"filename": session.filename, "path": str(file_path), "sha256": checksum}
+
+@app.delete("/uploads/{upload_id}")
+def abort_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    session = get_upload_session(upload_id)
+    session.part_path.unlink(missing_ok=True)
+    session.meta_path.unlink(missing_ok=True)
+    with UPLOAD_SESSIONS_LOCK:
+        UPLOAD_SESSIONS.pop(upload_id, None)
+    return {"message": "上传已取消"}
+
+class DirectoryIndex:
+    """持久化目录索引
+
+    记录每个目录的 mtime 和子目录列表，以及其中的视频文件。目录 mtime 未变说明其直接子项没有增删，
+    再次扫描时只需 stat 该目录 (无需 scandir 和逐个 stat 文件)，再沿缓存的子目录列表继续向下检查。
+    每次扫描分配递增的 scan_id，文件记录首次出现的 scan_id，用于返回上次扫描以来新增的文件。
+    """
+
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS index_dirs (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                subdirs TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS index_files (
+                path TEXT PRIMARY KEY,
+                dir TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                first_scan INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_index_files_dir ON index_files(dir)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS index_scans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                root TEXT NOT NULL,
+                prev_id INTEGER,
+                finished_at REAL
+            )
+        """)
+        # 查询走单独的只读连接：WAL 下读不会被 refresh() 长时间持有的写事务阻塞，也看不到未提交的半次扫描
+        self._read_lock = threading.Lock()
+        self._read_conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._read_conn.execute("PRAGMA query_only=ON")
+
+    @staticmethod
+    def _subtree(path: str) -> Tuple[str, str]:
+        # 以 path/ 开头的键范围：'0' 是 '/' 的下一个字符
+        return path.rstrip("/") + "/", path.rstrip("/") + "0"
+
+    def _drop_tree(self, path: str, removed: List[str]):
+        lo, hi = self._subtree(path)
+        removed.extend(r[0] for r in self._conn.execute(
+            "SELECT path FROM index_files WHERE path >= ? AND path < ?", (lo, hi)))
+        self._conn.execute("DELETE FROM index_files WHERE path >= ? AND path < ?", (lo, hi))
+        self._conn.execute("DELETE FROM index_dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, lo, hi))
+
+    def refresh(self, root: str) -> Dict[str, Any]:
+        """增量扫描 root，返回本次扫描的统计和删除的文件"""
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(id) FROM index_scans WHERE root = ?", (root,)).fetchone()
+            prev_id = row[0]
+            scan_id = self._conn.execute(
+                "INSERT INTO index_scans (root, prev_id) VALUES (?, ?)", (root, prev_id)).lastrowid
+            removed: List[str] = []
+            scanned = skipped = 0
+            self._conn.execute("BEGIN")
+            try:
+                stack = [root]
+                while stack:
+                    d = stack.pop()
+                    try:
+                        mtime_ns = os.stat(d).st_mtime_ns
+                    except OSError:
+                        self._drop_tree(d, removed)
+                        continue
+                    cached = self._conn.execute(
+                        "SELECT mtime_ns, subdirs FROM index_dirs WHERE path = ?", (d,)).fetchone()
+                    if cached and cached[0] == mtime_ns:
+                        skipped += 1
+                        stack.extend(os.path.join(d, name) for name in json.loads(cached[1]))
+                        continue
+
+                    scanned += 1
+                    subdirs = []
+                    files = {}
+                    try:
+                        with os.scandir(d) as it:
+                            for entry in it:
+                                try:
+                                    if entry.is_dir(follow_symlinks=False):
+                                        subdirs.append(entry.name)
+                                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in ALLOWED_EXTS:
+                                        st = entry.stat()
+                                        files[entry.path] = (st.st_size, st.st_mtime_ns)
+                                except OSError:
+                                    continue
+                    except OSError:
+                        self._drop_tree(d, removed)
+                        continue
+
+                    known = {r[0] for r in self._conn.execute("SELECT path FROM index_files WHERE dir = ?", (d,))}
+                    for gone in known - files.keys():
+                        self._conn.execute("DELETE FROM index_files WHERE path = ?", (gone,))
+                        removed.append(gone)
+                    self._conn.executemany("""
+                        INSERT INTO index_files (path, dir, size, mtime_ns, first_scan) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns
+                    """, [(path, d, size, mtime, scan_id) for path, (size, mtime) in files.items()])
+                    if cached:
+                        for name in set(json.loads(cached[1])) - set(subdirs):
+                            self._drop_tree(os.path.join(d, name), removed)
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO index_dirs (path, mtime_ns, subdirs) VALUES (?, ?, ?)",
+                        (d, mtime_ns, json.dumps(subdirs)),
+                    )
+                    stack.extend(os.path.join(d, name) for name in subdirs)
+                self._conn.execute("UPDATE index_scans SET finished_at = ? WHERE id = ?", (time.time(), scan_id))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return {
+                "scan_id": scan_id,
+                "prev_scan_id": prev_id,
+                "dirs_scanned": scanned,
+                "dirs_skipped": skipped,
+                "removed": removed,
+            }
+
+    def get_scan(self, scan_id: int) -> Optional[Tuple[str, Optional[int]]]:
+        with self._read_lock:
+            row = self._read_conn.execute("SELECT root, prev_id FROM index_scans WHERE id = ?", (scan_id,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def query(self, root: str, since_scan: Optional[int] = None, limit: Optional[int] = None, offset: int = 0) -> Tuple[int, List[str]]:
+        """返回 root 下 (可选：since_scan 之后新增) 的文件总数和按路径排序的一页结果"""
+        lo, hi = self._subtree(root)
+        where = "path >= ? AND path < ?"
+        args: List[Any] = [lo, hi]
+        if since_scan is not None:
+            where += " AND first_scan > ?"
+            args.append(since_scan)
+        sql = f"SELECT path FROM index_files WHERE {where} ORDER BY path LIMIT ? OFFSET ?"
+        with self._read_lock:
+            # 总数和分页放在同一个读事务里，保证两者来自同一快照
+            self._read_conn.execute("BEGIN")
+            try:
+                total = self._read_conn.execute(f"SELECT COUNT(*) FROM index_files WHERE {where}", args).fetchone()[0]
+                rows = self._read_conn.execute(sql, [*args, limit if limit is not None else -1, offset]).fetchall()
+            finally:
+                self._read_conn.execute("COMMIT")
+        return total, [r[0] for r in rows]
+
+DIRECTORY_INDEX = DirectoryIndex(CONFIG_DIR / "dir_index.db")
+# 单次响应最多返回的删除文件路径数
+SCAN_REMOVED_LIMIT = 1000
+
 @app.post("/scan-directory")
-def scan_directory(path: str = Form(...), current_user: User = Depends(get_current_user)):
+def scan_directory(
+    path: str = Form(...),
+    added_only: bool = Form(False),
+    scan_id: Optional[int] = Form(None),
+    offset: int = Form(0),
+    limit: Optional[int] = Form(None),
+    current_user: User = Depends(get_current_user),
+):
+    """扫描目录下的视频文件
+
+    - 不带 scan_id 时增量刷新索引并返回第一页；翻页时带上返回的 scan_id，不再重复扫描
+    - added_only=true 时只返回上次扫描该目录以来新增的文件
+    """
     base_path = Path(path)
     if not base_path.exists():
         raise HTTPException(status_code=400, detail="路径不存在")
     if not base_path.is_dir():
         raise HTTPException(status_code=400, detail="该路径不是目录")
-        
-    found_files = []
-    # 递归扫描
-    for p in base_path.rglob("*"):
-        if p.is_file() and p.suffix.lower() in ALLOWED_EXTS:
-            found_files.append(str(p))
-            
-    if not found_files:
-        raise HTTPException(status_code=400, detail="未找到视频文件")
-        
-    return {"count": len(found_files), "files": found_files}
+    root = os.path.abspath(str(base_path))
 
-@app.post("/transcode")
-def create_transcode_job(req: TranscodeRequest, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user)):
-    # 验证输入
-    if not req.inputs:
-        raise HTTPException(status_code=400, detail="没有输入文件")
-        
-    created_jobs = []
+    removed: List[str] = []
+    stats: Dict[str, Any] = {}
+    if scan_id is None:
+        stats = DIRECTORY_INDEX.refresh(root)
+        removed = stats.pop("removed")
+        scan_id = stats["scan_id"]
+        prev_scan_id = stats["prev_scan_id"]
+    else:
+        scan = DIRECTORY_INDEX.get_scan(scan_id)
+        if scan is None or scan[0] != root:
+            raise HTTPException(status_code=400, detail="扫描记录不存在")
+        prev_scan_id = scan[1]
+
+    # 首次扫描该目录时所有文件都算新增
+    since = (prev_scan_id or 0) if added_only else None
+    count, found_files = DIRECTORY_INDEX.query(root, since, limit, offset)
+
+    if not count and not added_only:
+        raise HTTPException(status_code=400, detail="未找到视频文件")
+
+    return {
+        "count": count,
+        "files": found_files,
+        "scan_id": scan_id,
+        "offset": offset,
+        "removed_count": len(removed),
+        "removed": removed[:SCAN_REMOVED_LIMIT],
+        **stats,
+    }
+
+# 后台准备任务 (ffprobe、指纹、流规划) 的线程数
+PREPARE_WORKERS = int(os.environ.get("PREPARE_WORKERS", 4))
+
+def clear_previews(inputs: List[str]):
+    """删除这些文件的旧预览 (包括视频、图片和缓存的统计信息)，整个批次只扫描一次预览目录"""
+    hashes = {get_path_hash(Path(inp)) for inp in inputs}
+    try:
+        entries = list(os.scandir(PREVIEW_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        # 文件名形如 preview_{路径hash}_...
+        if entry.name.startswith("preview_") and entry.name[8:40] in hashes:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+
+def prepare_job(job: JobStatus):
+    """探测源文件并补全任务的元数据，完成后交给调度器"""
+    if job.status != "preparing":
+        return
+    p = Path(job.inputs[0])
+    params = TranscodeParams(**job.params)
+    try:
+        # 获取源文件大小和时长
+        try:
+            if p.exists():
+                job.input_size = p.stat().st_size
+                job.duration = get_video_duration(p)
+        except:
+            pass
+        if p.exists():
+            try:
+                job.plan = plan_job(probe_media(p), params.model_copy(), job.duration)
+            except RuntimeError:
+                # 目标大小无法换算时先按原参数展示，执行时再报错
+                job.plan = plan_streams(probe_media(p), params)
+        # 资源估算 (探测结果已在上面缓存)
+        job.cost_cores, job.cost_memory_mb = estimate_job_cost(job)
+    except Exception as e:
+        print(f"Error preparing job {job.id}: {e}")
+    SCHEDULER.ready(job)
+
+class JobPreparer:
+    """后台任务准备线程池
+
+    提交大批文件时接口只写入 preparing 状态的任务就立即返回，
+    探测和预览清理在这里并行完成，每个任务准备好后单独进入调度队列，不必等整批结束。
+    """
+
+    def __init__(self, workers: int):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="job-prepare")
+
+    def submit(self, jobs: List[JobStatus]):
+        if jobs:
+            self._pool.submit(clear_previews, [job.inputs[0] for job in jobs])
+        for job in jobs:
+            self._pool.submit(prepare_job, job)
+
+JOB_PREPARER = JobPreparer(PREPARE_WORKERS)
+
+def create_jobs(inputs: List[str], params: TranscodeParams, output_dir: Optional[str] = None, priority: int = 0) -> List[JobStatus]:
+    """为每个输入文件创建一个独立任务并写入数据库
+
+    任务以 preparing 状态创建，探测等耗时工作由 JOB_PREPARER 在后台完成，
+    同一次调用创建的任务共用一个 batch_id。
+    """
+    new_jobs = []
+    batch = BatchStatus(id=uuid.uuid4().hex, priority=priority, output_dir=output_dir)
     
     # 预计算输出路径用于展示
-    out_dir = Path(req.output_dir) if req.output_dir else OUTPUT_DIR
-    suffix = f".{req.params.format}"
+    out_dir = Path(output_dir) if output_dir else OUTPUT_DIR
+    suffix = f".{params.format}"
     
     # 将每个输入文件拆分为独立任务
-    for inp in req.inputs:
-        job_id = uuid.uuid4().hex
+    for inp in inputs:
         p = Path(inp)
-        
-        # 清理该文件的旧预览 (包括视频和图片)
-        try:
-            path_hash = get_path_hash(p)
-            # 清理视频
-            for preview_file in PREVIEW_DIR.glob(f"preview_{path_hash}_*.mp4"):
-                try:
-                    preview_file.unlink()
-                except:
-                    pass
-            # 清理图片
-            for preview_img in PREVIEW_DIR.glob(f"preview_{path_hash}_*.jpg"):
-                try:
-                    preview_img.unlink()
-                except:
-                    pass
-        except:
-            pass
-        
-        # 获取源文件大小
-        input_size = 0
-        duration = 0.0
-        try:
-            if p.exists():
-                input_size = p.stat().st_size
-                duration = get_video_duration(p)
-        except:
-            pass
-        
-        # 单个任务的输出列表
-        single_output = [str(out_dir / (p.stem + suffix))]
-        
         job = JobStatus(
-            id=job_id,
+            id=uuid.uuid4().hex,
             inputs=[inp], # 只有这一个文件
-            outputs=single_output,
-            params=req.params.model_dump(),
-            status="pending", # 初始状态改为 pending
-            input_size=input_size,
-            duration=duration,
-            progress=0.0
+            outputs=[str(out_dir / (p.stem + suffix))],
+            params=params.model_dump(),
+            status="preparing",
+            progress=0.0,
+            priority=priority,
+            target_bytes=parse_size(params.target_size),
+            batch_id=batch.id,
         )
-        
-        JOBS[job_id] = job
-        # background_tasks.add_task(run_transcode_job, job_id)
-        # executor.submit(run_transcode_job, job_id)
-        created_jobs.append(job_id)
+        new_jobs.append(job)
     
-    # 尝试启动任务
-    try_start_jobs()
+    # 一次事务写入批次和所有新任务
+    JOB_STORE.save_many(new_jobs, batch)
+    
+    # 后台探测，准备好的任务逐个进入调度队列
+    JOB_PREPARER.submit(new_jobs)
+    return new_jobs
+
+@app.post("/transcode")
+def create_transcode_job(req: TranscodeRequest, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user)):
+    # 验证输入
+    if not req.inputs:
+        raise HTTPException(status_code=400, detail="没有输入文件")
+    if req.params.target_size and not parse_size(req.params.target_size):
+        raise HTTPException(status_code=400, detail=f"无法识别的目标大小: {req.params.target_size}")
+        
+    created_jobs = create_jobs(req.inputs, req.params, req.output_dir, req.priority)
     
     # 返回第一个 job_id 兼容旧前端，或者可以返回列表（前端需要适配）
     # 为了兼容现有前端（只接收一个 job_id），我们返回最后一个创建的 ID，
     # 但前端最好能刷新整个列表。
     # 实际上，现在的返回值前端并没有特别依赖 job_id 做跳转，而是刷新列表。
     # 返回 "created_count" 让前端知道创建了多少个。
+    # 探测在后台进行，接口立即返回，可通过 batch_id 跟踪整批任务。
     
-    return {"job_id": created_jobs[-1], "status": "running", "created_count": len(created_jobs)}
+    return {
+        "job_id": created_jobs[-1].id,
+        "batch_id": created_jobs[-1].batch_id,
+        "status": "preparing",
+        "created_count": len(created_jobs),
+    }
 
 @app.post("/jobs/cancel-all")
 def cancel_all_jobs(current_user: User = Depends(get_current_user)):
-    cancelled_count = 0
-    for job_id, job in JOBS.items():
-        if job.status in ["pending", "running"]:
-            # If running, terminate process
-            if job.status == "running" and job_id in JOB_PROCESSES:
-                try:
-                    JOB_PROCESSES[job_id].terminate()
-                except:
-                    pass
-            
-            job.status = "cancelled"
-            cancelled_count += 1
-            
+    cancelled_count = len(SCHEDULER.cancel(JOB_STORE.active_jobs()))
+    
     return {"message": f"已取消 {cancelled_count} 个任务", "count": cancelled_count}
 
+def retry_jobs(jobs: List[JobStatus]) -> int:
+    """把失败/取消的任务重置后重新排队，返回重置的数量"""
+    retried = []
+    for job in jobs:
+        # 准备完成前就被取消的任务还没有元数据，需要重新准备
+        job.status = "pending" if job.cost_cores is not None else "preparing"
+        job.progress = 0.0
+        job.error = None
+        job.completed_at = None
+        job.output_size = None
+        job.compression_ratio = None
+        job.target_deviation = None
+        job.reused_from = None
+        job.fps = job.speed = job.bitrate_kbps = job.eta = None
+        job.current_size = None
+        retried.append(job)
+    JOB_STORE.save_many(retried)
+    
+    if retried:
+        SCHEDULER.submit(retried)
+        JOB_PREPARER.submit([job for job in retried if job.status == "preparing"])
+    return len(retried)
+
 @app.post("/jobs/retry-all")
 def retry_all_jobs(current_user: User = Depends(get_current_user)):
-    retried_count = 0
-    for job in JOBS.values():
-        if job.status in ["failed", "cancelled"]:
-            job.status = "pending"
-            job.progress = 0.0
-            job.error = None
-            job.completed_at = None
-            job.output_size = None
-            job.compression_ratio = None
-            retried_count += 1
-            
-    if retried_count > 0:
-        try_start_jobs()
+    retried_count = retry_jobs(JOB_STORE.list(["failed", "cancelled"]))
         
     return {"message": f"已重置 {retried_count} 个任务", "count": retried_count}
 
 @app.post("/jobs/clear-completed")
 def clear_completed_jobs(current_user: User = Depends(get_current_user)):
     """清除所有已完成的任务"""
-    to_remove = []
-    for job_id, job in JOBS.items():
-        if job.status == "completed":
-            to_remove.append(job_id)
-    
-    for job_id in to_remove:
-        del JOBS[job_id]
-        # 可选：是否删除相关的预览文件？
-        # 目前预览文件保留，直到下次同名文件上传时覆盖。
+    removed = JOB_STORE.delete_by_status("completed")
+    # 可选：是否删除相关的预览文件？
+    # 目前预览文件保留，直到下次同名文件上传时覆盖。
         
-    return {"message": f"已清除 {len(to_remove)} 个已完成的任务", "count": len(to_remove)}
+    return {"message": f"已清除 {removed} 个已完成的任务", "count": removed}
 
 @app.post("/jobs/{job_id}/cancel")
 def cancel_job(job_id: str, current_user: User = Depends(get_current_user)):
-    if job_id not in JOBS:
+    job = JOB_STORE.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="任务不存在")
     
-    job = JOBS[job_id]
     if job.status in ["completed", "failed", "cancelled"]:
         return {"status": job.status, "message": "任务已结束"}
         
-    # 标记为已取消
-    job.status = "cancelled"
-    
-    # 终止进程
-    if job_id in JOB_PROCESSES:
-        process = JOB_PROCESSES[job_id]
-        try:
-            process.terminate() # 尝试优雅终止
-            # 也可以选择 kill() 强制终止
-        except Exception as e:
-            print(f"Error terminating process: {e}")
+    # 标记为已取消并终止进程
+    if not SCHEDULER.cancel([job]):
+        return {"status": job.status, "message": "任务已结束"}
             
     return {"status": "cancelled", "message": "任务已中止"}
 
+@app.post("/jobs/{job_id}/priority")
+def set_job_priority(job_id: str, priority: int = Form(...), current_user: User = Depends(get_current_user)):
+    """调整任务优先级，数值越大越先执行"""
+    job = JOB_STORE.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    if job.status not in ACTIVE_STATUSES:
+        raise HTTPException(status_code=400, detail="任务已结束")
+    SCHEDULER.set_priority([job], priority)
+    return {"id": job.id, "priority": job.priority, "status": job.status}
+
+# --- Batches ---
+
+@app.get("/batches", response_model=List[BatchStatus])
+def list_batches(
+    active: bool = False,
+    limit: int = Query(50, ge=1, le=1000),
+    current_user: User = Depends(get_current_user),
+):
+    """批次列表 (按创建时间倒序)，计数和进度直接取自内存中的汇总，不遍历任务；active 只返回未结束的批次"""
+    return BATCHES.list(limit, active)
+
+def get_batch_or_404(batch_id: str) -> BatchStatus:
+    batch = BATCHES.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="批次不存在")
+    return batch
+
+@app.get("/batches/{batch_id}", response_model=BatchStatus)
+def get_batch(batch_id: str, current_user: User = Depends(get_current_user)):
+    return get_batch_or_404(batch_id)
+
+@app.post("/batches/{batch_id}/cancel")
+def cancel_batch(batch_id: str, current_user: User = Depends(get_current_user)):
+    """取消批次中所有未结束的任务"""
+    get_batch_or_404(batch_id)
+    cancelled = SCHEDULER.cancel([j for j in JOB_STORE.active_jobs() if j.batch_id == batch_id])
+    return {"message": f"已取消 {len(cancelled)} 个任务", "count": len(cancelled)}
+
+@app.post("/batches/{batch_id}/retry")
+def retry_batch(batch_id: str, current_user: User = Depends(get_current_user)):
+    """重试批次中失败或取消的任务"""
+    get_batch_or_404(batch_id)
+    retried_count = retry_jobs(JOB_STORE.list(["failed", "cancelled"], batch_id=batch_id))
+    return {"message": f"已重置 {retried_count} 个任务", "count": retried_count}
+
+@app.post("/batches/{batch_id}/priority")
+def set_batch_priority(batch_id: str, priority: int = Form(...), current_user: User = Depends(get_current_user)):
+    """调整批次中所有未结束任务的优先级"""
+    batch = get_batch_or_404(batch_id)
+    batch.priority = priority
+    JOB_STORE.save_batch(batch)
+    BATCHES.set_priority(batch_id, priority)
+    jobs = [j for j in JOB_STORE.active_jobs() if j.batch_id == batch_id]
+    SCHEDULER.set_priority(jobs, priority)
+    return {"id": batch_id, "priority": priority, "count": len(jobs)}
+
 def get_path_hash(path: Path) -> str:
     """计算路径的哈希值，用于关联预览文件"""
     return hashlib.md5(str(path).encode('utf-8')).hexdigest()
 
+PREVIEW_CLIP_SECONDS = 5
+PREVIEW_FRAME_FPS = 2
+
+def preview_cache_key(input_path: Path, params: TranscodeParams) -> str:
+    """预览缓存键：输入文件指纹 (路径/大小/修改时间) + 规范化后的转码参数"""
+    st = input_path.stat()
+    # 线程数和分段数不影响预览画面，不参与缓存键
+    normalized = params.model_dump(exclude={"threads", "segments"})
+    raw = json.dumps([str(input_path), st.st_size, st.st_mtime_ns, normalized], sort_keys=True)
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+def preview_frame_filters(params: TranscodeParams) -> str:
+    """静态帧输出的滤镜链：与预览视频相同的反交错/缩放/旋转，使用 CPU 滤镜"""
+    filters = []
+    if params.hw_accel and params.hw_accel != "cpu":
+        # 硬件解码的帧需先下载到内存
+        filters.append("hwdownload,format=nv12")
+    if params.deinterlace:
+        filters.append("yadif")
+    if params.resolution:
+        filters.append(f"scale={params.resolution}")
+    rot_map = {"90": "transpose=1", "180": "transpose=1,transpose=1", "270": "transpose=2"}
+    if params.rotation in rot_map:
+        filters.append(rot_map[params.rotation])
+    filters.append(f"fps={PREVIEW_FRAME_FPS}")
+    return ",".join(filters)
+
+def preview_files(input_path: Path, params: TranscodeParams) -> Tuple[TranscodeParams, str, Path, Path]:
+    """预览实际使用的参数，以及缓存文件的 (前缀, 预览视频, 统计 JSON)"""
+    params = params.model_copy()
+    params.format = "mp4" # 强制预览为 mp4 容器
+    params.scodec = "none" # 预览时禁用字幕，防止 TS 图形字幕(dvb_sub)转 MP4 失败
+
+    prefix = f"preview_{get_path_hash(input_path)}_{preview_cache_key(input_path, params)}"
+    return params, prefix, PREVIEW_DIR / f"{prefix}.mp4", PREVIEW_DIR / f"{prefix}.json"
+
+def cached_preview(input_path: Path, params: TranscodeParams) -> Optional[Dict[str, Any]]:
+    """参数未变且预览文件仍在时返回缓存结果，否则返回 None"""
+    _, _, preview_path, stats_path = preview_files(input_path, params)
+    if stats_path.exists() and preview_path.exists():
+        try:
+            result = json.loads(stats_path.read_text())
+            # 刷新修改时间，供清理线程按最近使用淘汰
+            os.utime(stats_path)
+            return result
+        except (OSError, ValueError):
+            pass
+    return None
+
+def generate_preview(input_path: Path, params: TranscodeParams) -> Dict[str, Any]:
+    """生成预览片段和静态帧 (单次 ffmpeg)，结果按输入指纹和参数缓存"""
+    # 排队期间可能已有相同的预览完成
+    result = cached_preview(input_path, params)
+    if result is not None:
+        return result
+    params, prefix, preview_path, stats_path = preview_files(input_path, params)
+
+    # 获取时长并计算中间点
+    duration = get_video_duration(input_path)
+    # target_size 换算出的码率与任务一致 (缓存键已包含 target_size)
+    if params.target_size:
+        plan_job(probe_media(input_path), params, duration)
+    start_time = max(0, duration / 2 - PREVIEW_CLIP_SECONDS / 2) # 从中间开始，或者至少0
+
+    # 截取 5 秒
+    input_options = ["-ss", str(start_time), "-t", str(PREVIEW_CLIP_SECONDS)]
+    cmd = build_ffmpeg_cmd(input_path, preview_path, params, input_options)
+
+    # 同一次解码额外输出静态帧 (fps=2, 5秒 = 10帧)，不再对预览视频二次解码
+    frame_pattern = f"{prefix}_frame_%03d.jpg"
+    cmd.extend([
+        "-map", "0:v:0", "-an", "-sn",
+        "-vf", preview_frame_filters(params),
+        "-frames:v", str(PREVIEW_CLIP_SECONDS * PREVIEW_FRAME_FPS),
+        str(PREVIEW_DIR / frame_pattern),
+    ])
+
+    process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg Preview Error: {process.stdout}")
+
+    # 计算预估体积和压缩率
+    preview_size = preview_path.stat().st_size
+    source_size = input_path.stat().st_size
+
+    # 收集生成的图片 URL
+    preview_images = [
+        f"/previews/{img_file.name}"
+        for img_file in sorted(PREVIEW_DIR.glob(frame_pattern.replace("%03d", "*")))
+    ]
+
+    estimate_info = {
+        "source_size": source_size,
+        "preview_size": preview_size,
+        "duration": duration,
+        "estimated_full_size": 0,
+        "compression_ratio": 0.0
+    }
+
+    if duration > 0:
+        # 简单估算：预览5秒 -> 完整时长
+        # 注意：如果实际截取不足5秒（视频短于5秒），这里的估算会有偏差，但通常预览针对长视频
+        actual_preview_duration = min(float(PREVIEW_CLIP_SECONDS), duration)
+        ratio = duration / actual_preview_duration
+        estimated_full_size = preview_size * ratio
+
+        estimate_info["estimated_full_size"] = int(estimated_full_size)
+        if source_size > 0:
+            # 压缩率：(原大小 - 预估大小) / 原大小
+            estimate_info["compression_ratio"] = (source_size - estimated_full_size) / source_size
+
+    # 返回预览 URL 和 统计信息
+    result = {
+        "preview_url": f"/previews/{preview_path.name}",
+        "preview_images": preview_images, # 返回图片列表
+        "stats": estimate_info
+    }
+    stats_path.write_text(json.dumps(result))
+    return result
+
+class PreviewQueue:
+    """预览/预估请求队列
+
+    请求按到达顺序异步等待空闲槽位；相同的请求合并到同一个进行中的任务。
+    等待超时时返回 503 和当前排队位置，任务本身继续执行，重试时会合并到该任务或命中预览缓存。
+    """
+
+    def __init__(self, slots: int, max_waiting: int, timeout: float):
+        self.slots = slots
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="preview")
+        self._semaphore = asyncio.Semaphore(slots)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._waiting: List[str] = []
+        self._running = 0
+
+    @property
+    def running_count(self) -> int:
+        return self._running
+
+    @property
+    def waiting_count(self) -> int:
+        return len(self._waiting)
+
+    def position(self, key: str) -> int:
+        """排队位置 (从 1 开始)，0 表示正在执行"""
+        try:
+            return self._waiting.index(key) + 1
+        except ValueError:
+            return 0
+
+    async def run(self, key: str, func, *args):
+        fut = self._inflight.get(key)
+        if fut is None:
+            if len(self._waiting) >= self.max_waiting:
+                raise HTTPException(status_code=503, detail="系统正忙，请稍后再试 (预览任务队列已满)")
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight[key] = fut
+            self._waiting.append(key)
+            asyncio.create_task(self._execute(key, fut, func, args))
+        try:
+            # shield: 单个请求超时不影响合并到同一任务的其他请求
+            return await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+        except asyncio.TimeoutError:
+            position = self.position(key)
+            raise HTTPException(
+                status_code=503,
+                detail=f"预览排队中 (第 {position} 位)，请稍后重试" if position else "预览生成中，请稍后重试",
+                headers={"Retry-After": "1", "X-Queue-Position": str(position)},
+            )
+
+    async def _execute(self, key: str, fut: asyncio.Future, func, args):
+        try:
+            async with self._semaphore:
+                self._waiting.remove(key)
+                self._running += 1
+                started = time.monotonic()
+                try:
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(self._executor, func, *args)
+                finally:
+                    self._running -= 1
+                    PREVIEW_SECONDS.observe(time.monotonic() - started, func.__name__)
+            fut.set_result(result)
+        except Exception as e:
+            fut.set_exception(e)
+            # 避免无人等待时出现 "exception was never retrieved" 警告
+            fut.exception()
+        finally:
+            self._inflight.pop(key, None)
+
+PREVIEW_QUEUE = PreviewQueue(PREVIEW_CONCURRENCY, PREVIEW_QUEUE_SIZE, PREVIEW_QUEUE_TIMEOUT)
+
+def preview_request_key(kind: str, input_path: Path, params: TranscodeParams, *extra) -> str:
+    return hashlib.md5(json.dumps([kind, str(input_path), params.model_dump(), *extra]).encode('utf-8')).hexdigest()
+
+async def run_preview_task(key: str, func, *args):
+    try:
+        return await PREVIEW_QUEUE.run(key, func, *args)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/preview/queue")
+def get_preview_queue(current_user: User = Depends(get_current_user)):
+    return {
+        "slots": PREVIEW_QUEUE.slots,
+        "running": PREVIEW_QUEUE.running_count,
+        "waiting": PREVIEW_QUEUE.waiting_count,
+    }
+
+ESTIMATE_SAMPLE_SECONDS = 4
+ESTIMATE_MAX_SAMPLES = 12
+
+def encode_sample(input_path: Path, output_path: Path, params: TranscodeParams, start: float, length: float) -> Tuple[int, float]:
+    """编码一个采样片段，返回 (输出字节数, 耗时秒)"""
+    cmd = build_ffmpeg_cmd(input_path, output_path, params, ["-ss", f"{start:.3f}", "-t", f"{length:.3f}"])
+    started = time.monotonic()
+    process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.monotonic() - started
+    if process.returncode != 0:
+        tail = "\n".join(process.stderr.strip().splitlines()[-5:])
+        raise RuntimeError(f"FFmpeg Sample Error: Return Code {process.returncode}\n{tail}")
+    return output_path.stat().st_size, elapsed
+
+def estimate_output(input_path: Path, params: TranscodeParams, samples: int) -> Dict[str, Any]:
+    """在全片均匀分布的 K 个位置并行编码短片段，估算完整输出体积 (含最小/最大范围) 和编码耗时"""
+    params = params.model_copy()
+    params.scodec = "none" # 采样时禁用字幕，字幕对体积影响可忽略
+    params.segments = None
+
+    prefix = f"preview_{get_path_hash(input_path)}_{preview_cache_key(input_path, params)}"
+    stats_path = PREVIEW_DIR / f"{prefix}_estimate_{samples}.json"
+    if stats_path.exists():
+        try:
+            return json.loads(stats_path.read_text())
+        except (OSError, ValueError):
+            pass
+
+    duration = get_video_duration(input_path)
+    if duration <= 0:
+        raise RuntimeError("无法获取视频时长")
+    # target_size 换算出的码率与任务一致 (缓存键已包含 target_size)
+    if params.target_size:
+        plan_job(probe_media(input_path), params, duration)
+
+    # 采样点取各等分区间的中心，片段总长不超过全片
+    length = min(float(ESTIMATE_SAMPLE_SECONDS), duration / samples)
+    starts = [max(0.0, (i + 0.5) * duration / samples - length / 2) for i in range(samples)]
+    # 并行采样时平分 CPU 线程，避免互相抢占导致速度测量失真
+    if not params.threads:
+        params.threads = max(1, CPU_BUDGET // samples)
+
+    suffix = f".{params.format}" if params.format else ".mp4"
+    outputs = [SEGMENT_DIR / f"estimate_{uuid.uuid4().hex}{suffix}" for _ in starts]
+    SEGMENT_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=samples, thread_name_prefix="estimate") as pool:
+            results = list(pool.map(
+                lambda args: encode_sample(input_path, args[0], params, args[1], length),
+                zip(outputs, starts),
+            ))
+        elapsed = time.monotonic() - started
+    finally:
+        for out in outputs:
+            out.unlink(missing_ok=True)
+
+    # 每个采样的码率 (字节/秒) 外推到全片
+    rates = [size / length for size, _ in results]
+    estimated = sum(rates) / len(rates) * duration
+    source_size = input_path.stat().st_size
+    # 所有采样并行完成的吞吐量近似整机转码速度
+    speed = samples * length / elapsed if elapsed > 0 else 0.0
+
+    result = {
+        "samples": samples,
+        "sample_duration": length,
+        "duration": duration,
+        "source_size": source_size,
+        "estimated_full_size": int(estimated),
+        "estimated_min_size": int(min(rates) * duration),
+        "estimated_max_size": int(max(rates) * duration),
+        "compression_ratio": (source_size - estimated) / source_size if source_size > 0 else 0.0,
+        "speed": speed,
+        "estimated_time": duration / speed if speed > 0 else None,
+        "elapsed": elapsed,
+    }
+    stats_path.write_text(json.dumps(result))
+    return result
+
+@app.post("/preview/estimate")
+async def create_estimate(req: TranscodeRequest, samples: int = Query(3, ge=1, le=ESTIMATE_MAX_SAMPLES), current_user: User = Depends(get_current_user)):
+    """多点采样估算输出体积和编码耗时；采样数越多越准确，但耗时越长"""
+    if not req.inputs:
+        raise HTTPException(status_code=400, detail="没有输入文件")
+
+    input_path = Path(req.inputs[0])
+    if not input_path.exists():
+        raise HTTPException(status_code=400, detail="输入文件不存在")
+
+    if req.params.target_size and not parse_size(req.params.target_size):
+        raise HTTPException(status_code=400, detail=f"无法识别的目标大小: {req.params.target_size}")
+
+    key = preview_request_key("estimate", input_path, req.params, samples)
+    return await run_preview_task(key, estimate_output, input_path, req.params, samples)
+
 @app.post("/preview")
-def create_preview(req: TranscodeRequest, current_user: User = Depends(get_current_user)):
+async def create_preview(req: TranscodeRequest, current_user: User = Depends(get_current_user)):
     if not req.inputs:
         raise HTTPException(status_code=400, detail="没有输入文件")
         
     input_path = Path(req.inputs[0])
     if not input_path.exists():
         raise HTTPException(status_code=400, detail="输入文件不存在")
-        
-    # 获取时长并计算中间点
-    duration = get_video_duration(input_path)
-    start_time = max(0, duration / 2 - 2.5) # 从中间开始，或者至少0
-    
-    # 生成预览文件名
-    preview_filename = f"preview_{get_path_hash(input_path)}_{uuid.uuid4().hex}.mp4"
-    preview_path = PREVIEW_DIR / preview_filename
-    
-    # 强制 mp4 格式用于 Web 预览
+
     # 注意：如果用户选了 mkv/mov 等，预览时最好也转为 mp4 以便浏览器播放
-    # 但为了真实反映参数效果，我们应尽量保持视频编码参数，只改变封装格式?
-    # 或者如果浏览器不支持该编码(如 hevc)，预览可能无法播放。
-    # 这里我们假设用户参数是浏览器兼容的，或者用户只关心压缩率/画质。
     # 为了保证能播放，我们强制后缀 .mp4，但编码器使用用户参数。
     # 如果用户选了 hevc，Chrome 可能播放不了（取决于硬件），但这是预览的局限性。
-    
-    req.params.format = "mp4" # 强制预览为 mp4 容器
-    req.params.scodec = "none" # 预览时禁用字幕，防止 TS 图形字幕(dvb_sub)转 MP4 失败
-    
-    # 截取 5 秒
-    input_options = ["-ss", str(start_time), "-t", "5"]
-    
-    cmd = build_ffmpeg_cmd(input_path, preview_path, req.params, input_options)
-    
-    # 使用信号量限制并发预览
-    if not PREVIEW_SEMAPHORE.acquire(blocking=False):
-         raise HTTPException(status_code=503, detail="系统正忙，请稍后再试 (预览任务队列已满)")
 
+    if req.params.target_size and not parse_size(req.params.target_size):
+        raise HTTPException(status_code=400, detail=f"无法识别的目标大小: {req.params.target_size}")
+
+    # 命中缓存时直接返回，只有需要运行 ffmpeg 的请求才占用预览队列的槽位
     try:
+        cached = await run_blocking(cached_preview, input_path, req.params)
+    except OSError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if cached is not None:
+        return cached
+
+    # 通过预览队列限制并发，相同请求合并执行
+    key = preview_request_key("preview", input_path, req.params)
+    return await run_preview_task(key, generate_preview, input_path, req.params)
+
+# --- 转码参数预设 ---
+PRESETS_FILE = CONFIG_DIR / "presets.json"
+_presets_lock = threading.Lock()
+
+def load_presets() -> Dict[str, TranscodeParams]:
+    try:
+        raw = json.loads(PRESETS_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        raw = {}
+    presets = {name: TranscodeParams(**params) for name, params in raw.items()}
+    presets.setdefault("default", TranscodeParams())
+    return presets
+
+def save_presets(presets: Dict[str, TranscodeParams]):
+    with open(PRESETS_FILE, "w", encoding="utf-8") as f:
+        json.dump({name: p.model_dump() for name, p in presets.items()}, f, indent=2, ensure_ascii=False)
+
+@app.get("/presets")
+def list_presets(current_user: User = Depends(get_current_user)):
+    return {name: p.model_dump() for name, p in load_presets().items()}
+
+@app.put("/presets/{name}")
+def put_preset(name: str, params: TranscodeParams, current_user: User = Depends(get_current_user)):
+    with _presets_lock:
+        presets = load_presets()
+        presets[name] = params
+        save_presets(presets)
+    return {"message": f"预设 {name} 已保存"}
+
+@app.delete("/presets/{name}")
+def delete_preset(name: str, current_user: User = Depends(get_current_user)):
+    with _presets_lock:
+        presets = load_presets()
+        if name not in presets:
+            raise HTTPException(status_code=404, detail="预设不存在")
+        del presets[name]
+        save_presets(presets)
+    return {"message": f"预设 {name} 已删除"}
+
+# --- 监视文件夹自动入队 ---
+WATCH_FOLDERS_FILE = CONFIG_DIR / "watch_folders.json"
+# inotify 可用时定期全量复查的间隔 (弥补丢失的事件)；不可用时的轮询间隔
+WATCH_RESCAN_INTERVAL = float(os.environ.get("WATCH_RESCAN_INTERVAL", 300))
+WATCH_POLL_INTERVAL = float(os.environ.get("WATCH_POLL_INTERVAL", 30))
+# 文件大小和修改时间保持不变超过该秒数才认为写入完成
+WATCH_STABLE_SECONDS = float(os.environ.get("WATCH_STABLE_SECONDS", 10))
+WATCH_CHECK_INTERVAL = 2.0
+
+class WatchFolder(BaseModel):
+    path: str
+    preset: str = "default"
+    output_dir: Optional[str] = None
+    recursive: bool = True
+    enabled: bool = True
+    priority: int = 0
+
+class Inotify:
+    """基于 ctypes 的最小 inotify 封装，非 Linux 或不可用时构造抛出 OSError"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
         try:
-            # 同步执行预览生成 (通常 5秒片段很快)
-            process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-            if process.returncode != 0:
-                 raise RuntimeError(f"FFmpeg Preview Error: {process.stdout}")
-                 
-            # 计算预估体积和压缩率
-            preview_size = preview_path.stat().st_size
-            source_size = input_path.stat().st_size
-            
-            # --- 新增：抽取10帧画面 ---
-            # 从生成的预览视频中抽取 10 帧 (fps=2, 5秒 = 10帧)
-            # 输出格式: preview_{hash}_{uuid}_frame_%03d.jpg
-            frame_pattern = f"preview_{get_path_hash(input_path)}_{uuid.uuid4().hex}_frame_%03d.jpg"
-            frame_output_path = PREVIEW_DIR / frame_pattern
-            
-            # 使用 ffmpeg 提取帧
-            # -vf fps=2 保证 5秒视频输出约 10 帧
-            extract_cmd = [
-                "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
-                "-i", str(preview_path),
-                "-vf", "fps=2",
-                str(frame_output_path)
-            ]
-            subprocess.run(extract_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            # 收集生成的图片 URL
-            preview_images = []
-            # 查找生成的文件 (glob pattern)
-            # frame_pattern 包含 %03d，我们需要匹配它
-            # glob pattern: frame_pattern with %03d replaced by *
-            glob_pattern = frame_pattern.replace("%03d", "*")
-            for img_file in sorted(PREVIEW_DIR.glob(glob_pattern)):
-                preview_images.append(f"/previews/{img_file.name}")
-            
-            estimate_info = {
-                "source_size": source_size,
-                "preview_size": preview_size,
-                "duration": duration,
-                "estimated_full_size": 0,
-                "compression_ratio": 0.0
-            }
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify 不可用: {e}")
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.fd = fd
+        self._watches: Dict[int, str] = {}
 
-            if duration > 0:
-                # 简单估算：预览5秒 -> 完整时长
-                # 注意：如果实际截取不足5秒（视频短于5秒），这里的估算会有偏差，但通常预览针对长视频
-                actual_preview_duration = min(5.0, duration)
-                ratio = duration / actual_preview_duration
-                estimated_full_size = preview_size * ratio
-                
-                estimate_info["estimated_full_size"] = int(estimated_full_size)
-                if source_size > 0:
-                    # 压缩率：(原大小 - 预估大小) / 原大小
-                    estimate_info["compression_ratio"] = (source_size - estimated_full_size) / source_size
+    def add_watch(self, path: str):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch 失败: {path}")
+        self._watches[wd] = path
+
+    def read(self, timeout: float) -> List[Tuple[str, int]]:
+        """等待最多 timeout 秒，返回 (完整路径, 事件掩码) 列表"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            base = self._watches.get(wd, "")
+            events.append((os.path.join(base, os.fsdecode(name)) if name else base, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    """监视文件夹，新视频写入完成后用指定预设自动创建转码任务
+
+    优先使用 inotify，并定期全量复查；inotify 不可用 (或网络挂载收不到事件) 时退化为定期轮询。
+    已处理过的文件记录在 SQLite 中，服务重启后不会重复入队；首次监视某目录时其中已有的文件只记录不入队。
+    """
+
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS watch_seen (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS watch_roots (path TEXT PRIMARY KEY)")
+        self.folders = self._load_folders()
+        # 候选文件: path -> [size, mtime_ns, 稳定起始时间, WatchFolder]
+        self._candidates: Dict[str, list] = {}
+        self._reload = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.mode: Optional[str] = None
+        self.enqueued = 0
+
+    @staticmethod
+    def _load_folders() -> List[WatchFolder]:
+        try:
+            return [WatchFolder(**f) for f in json.loads(WATCH_FOLDERS_FILE.read_text(encoding="utf-8"))]
+        except (OSError, ValueError):
+            # 默认监视 INPUT_DIR，需显式开启以免上传的文件被意外转码
+            enabled = os.environ.get("WATCH_INPUT_DIR", "").lower() in ("1", "true", "yes")
+            return [WatchFolder(path=str(INPUT_DIR), enabled=enabled)]
+
+    def configure(self, folders: List[WatchFolder]):
+        with open(WATCH_FOLDERS_FILE, "w", encoding="utf-8") as f:
+            json.dump([folder.model_dump() for folder in folders], f, indent=2, ensure_ascii=False)
+        with self._lock:
+            self.folders = folders
+        self._reload.set()
 
-            # 返回预览 URL 和 统计信息
-            preview_url = f"/previews/{preview_filename}"
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="watcher", daemon=True)
+            self._thread.start()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
             return {
-                "preview_url": preview_url,
-                "preview_images": preview_images, # 返回图片列表
-                "stats": estimate_info
+                "mode": self.mode,
+                "folders": [f.model_dump() for f in self.folders],
+                "pending": sorted(self._candidates),
+                "enqueued": self.enqueued,
             }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        PREVIEW_SEMAPHORE.release()
+
+    def _active_folders(self) -> List[WatchFolder]:
+        with self._lock:
+            return [f for f in self.folders if f.enabled and os.path.isdir(f.path)]
+
+    @staticmethod
+    def _walk_dirs(folder: WatchFolder):
+        if not folder.recursive:
+            yield folder.path
+            return
+        for root, dirs, _ in os.walk(folder.path):
+            # 跳过隐藏目录 (如分块上传的 .uploads)
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            yield root
+
+    @staticmethod
+    def _video_files(directory: str):
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file() and not entry.name.startswith(".") \
+                            and os.path.splitext(entry.name)[1].lower() in ALLOWED_EXTS:
+                        yield entry.path
+        except OSError:
+            return
+
+    def _folder_for(self, path: str, folders: List[WatchFolder]) -> Optional[WatchFolder]:
+        best = None
+        for folder in folders:
+            root = folder.path.rstrip("/") + "/"
+            if not path.startswith(root):
+                continue
+            if not folder.recursive and os.path.dirname(path) != folder.path.rstrip("/"):
+                continue
+            if best is None or len(folder.path) > len(best.path):
+                best = folder
+        return best
+
+    def _note(self, path: str, folder: WatchFolder):
+        """记录一个可能的新文件，等待其停止增长"""
+        if path in self._candidates:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        row = self._conn.execute("SELECT size, mtime_ns FROM watch_seen WHERE path = ?", (path,)).fetchone()
+        if row and tuple(row) == (st.st_size, st.st_mtime_ns):
+            return
+        with self._lock:
+            self._candidates[path] = [st.st_size, st.st_mtime_ns, time.monotonic(), folder]
+
+    def _rescan(self, folders: List[WatchFolder]):
+        for folder in folders:
+            baseline = self._conn.execute(
+                "SELECT 1 FROM watch_roots WHERE path = ?", (folder.path,)).fetchone() is None
+            for directory in self._walk_dirs(folder):
+                for path in self._video_files(directory):
+                    if baseline:
+                        st = os.stat(path)
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO watch_seen (path, size, mtime_ns) VALUES (?, ?, ?)",
+                            (path, st.st_size, st.st_mtime_ns))
+                    elif self._folder_for(path, folders) is folder:
+                        self._note(path, folder)
+            if baseline:
+                self._conn.execute("INSERT OR IGNORE INTO watch_roots (path) VALUES (?)", (folder.path,))
+
+    def _check_candidates(self):
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, cand in list(self._candidates.items()):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    del self._candidates[path]
+                    continue
+                if (st.st_size, st.st_mtime_ns) != (cand[0], cand[1]):
+                    # 仍在写入，重新计时
+                    cand[0], cand[1], cand[2] = st.st_size, st.st_mtime_ns, now
+                elif now - cand[2] >= WATCH_STABLE_SECONDS:
+                    ready.append((path, cand))
+                    del self._candidates[path]
+        for path, (size, mtime_ns, _, folder) in ready:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO watch_seen (path, size, mtime_ns) VALUES (?, ?, ?)", (path, size, mtime_ns))
+            params = load_presets().get(folder.preset)
+            if params is None:
+                print(f"Watch folder {folder.path}: preset '{folder.preset}' not found, skipping {path}")
+                continue
+            try:
+                create_jobs([path], params, folder.output_dir, folder.priority)
+                self.enqueued += 1
+            except Exception as e:
+                print(f"Watch folder {folder.path}: failed to enqueue {path}: {e}")
+
+    def _watch_tree(self, inotify: Inotify, folder: WatchFolder, top: Optional[str] = None) -> List[str]:
+        """为 top (默认整个监视目录) 及其子目录添加 inotify 监视，返回这些目录"""
+        tree = folder if top is None else folder.model_copy(update={"path": top})
+        dirs = list(self._walk_dirs(tree))
+        for directory in dirs:
+            try:
+                inotify.add_watch(directory)
+            except OSError as e:
+                print(f"Watch folder: {e}")
+        return dirs
+
+    def _loop(self):
+        while True:
+            folders = self._active_folders()
+            inotify = None
+            if folders:
+                try:
+                    inotify = Inotify()
+                    for folder in folders:
+                        self._watch_tree(inotify, folder)
+                except OSError as e:
+                    print(f"Watch folder: {e}, falling back to polling")
+                    inotify = None
+            self.mode = None if not folders else ("inotify" if inotify else "polling")
+            interval = WATCH_RESCAN_INTERVAL if inotify else WATCH_POLL_INTERVAL
+
+            next_scan = 0.0
+            while not self._reload.is_set():
+                try:
+                    if inotify is not None:
+                        for path, mask in inotify.read(WATCH_CHECK_INTERVAL):
+                            if mask & Inotify.IN_Q_OVERFLOW:
+                                next_scan = 0.0
+                                continue
+                            folder = self._folder_for(path, folders)
+                            if folder is None:
+                                continue
+                            if mask & Inotify.IN_ISDIR:
+                                # 新建或移入的子目录：加入监视并检查其中已有的文件
+                                if folder.recursive and not os.path.basename(path).startswith("."):
+                                    for directory in self._watch_tree(inotify, folder, path):
+                                        for fpath in self._video_files(directory):
+                                            self._note(fpath, folder)
+                            elif os.path.splitext(path)[1].lower() in ALLOWED_EXTS \
+                                    and not os.path.basename(path).startswith("."):
+                                self._note(path, folder)
+                    else:
+                        self._reload.wait(WATCH_CHECK_INTERVAL)
+                    if folders and time.monotonic() >= next_scan:
+                        self._rescan(folders)
+                        next_scan = time.monotonic() + interval
+                    self._check_candidates()
+                except Exception as e:
+                    print(f"Watch folder error: {e}")
+                    self._reload.wait(WATCH_CHECK_INTERVAL)
+            self._reload.clear()
+            if inotify is not None:
+                inotify.close()
+
+WATCHER = FolderWatcher(CONFIG_DIR / "watch.db")
+
+@app.get("/watch-folders")
+def get_watch_folders(current_user: User = Depends(get_current_user)):
+    return WATCHER.status()
+
+@app.put("/watch-folders")
+def set_watch_folders(folders: List[WatchFolder], current_user: User = Depends(get_current_user)):
+    presets = load_presets()
+    for folder in folders:
+        if folder.preset not in presets:
+            raise HTTPException(status_code=400, detail=f"预设不存在: {folder.preset}")
+        watch = os.path.abspath(folder.path)
+        out = os.path.abspath(folder.output_dir or str(OUTPUT_DIR))
+        # 输出目录在监视范围内会导致转码结果被再次入队
+        if out == watch or (folder.recursive and out.startswith(watch.rstrip("/") + "/")):
+            raise HTTPException(status_code=400, detail=f"输出目录不能位于监视目录内: {folder.path}")
+        folder.path = watch
+    WATCHER.configure(folders)
+    return WATCHER.status()
+
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", 600))
+PREVIEW_CACHE_MB = int(os.environ.get("PREVIEW_CACHE_MB", 1024))
+PREVIEW_MAX_AGE_HOURS = float(os.environ.get("PREVIEW_MAX_AGE_HOURS", 72))
+THUMBNAIL_MAX_AGE_DAYS = float(os.environ.get("THUMBNAIL_MAX_AGE_DAYS", 30))
+UPLOAD_MAX_AGE_HOURS = float(os.environ.get("UPLOAD_MAX_AGE_HOURS", 72))
+PASSLOG_MAX_AGE_DAYS = float(os.environ.get("PASSLOG_MAX_AGE_DAYS", 7))
+# 分段/采样临时文件超过该时间且不属于运行中的任务即视为残留
+SEGMENT_MAX_AGE_SECONDS = 3600
+
+def evict_lru(entries: List[Tuple[float, int, List[str]]], max_bytes: Optional[int], max_age: Optional[float]) -> Tuple[int, int, int]:
+    """按最近使用时间淘汰缓存条目
+
+    entries 为 (mtime, 字节数, 文件列表)；先删除超龄条目，再从最旧的开始删除直到总大小不超过配额。
+    返回 (删除文件数, 删除字节数, 剩余字节数)
+    """
+    entries = sorted(entries)
+    total = sum(size for _, size, _ in entries)
+    cutoff = time.time() - max_age if max_age else None
+    removed_files = removed_bytes = 0
+    for mtime, size, paths in entries:
+        expired = cutoff is not None and mtime < cutoff
+        if not expired and (max_bytes is None or total <= max_bytes):
+            break
+        for path in paths:
+            try:
+                os.unlink(path)
+                removed_files += 1
+            except OSError:
+                pass
+        total -= size
+        removed_bytes += size
+    return removed_files, removed_bytes, total
+
+class Janitor:
+    """后台清理线程：预览/缩略图缓存按大小和时间配额淘汰，清理临时分段、两遍编码日志和过期的上传会话
+
+    失败/取消任务的残留输出由任务线程在结束时直接删除，这里只累计统计 (outputs)。
+    """
+
+    CATEGORIES = ("previews", "thumbnails", "outputs", "segments", "passlogs", "uploads")
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.runs = 0
+        self.errors = 0
+        self.last_run: Optional[float] = None
+        self.last_duration = 0.0
+        self.removed_files = {c: 0 for c in self.CATEGORIES}
+        self.removed_bytes = {c: 0 for c in self.CATEGORIES}
+        self.preview_bytes = 0
+        self.thumbnail_bytes = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="janitor", daemon=True)
+            self._thread.start()
+
+    def trigger(self):
+        self._wakeup.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval": self.interval,
+            "runs": self.runs,
+            "errors": self.errors,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "removed_files": dict(self.removed_files),
+            "removed_bytes": dict(self.removed_bytes),
+            "preview_bytes": self.preview_bytes,
+            "thumbnail_bytes": self.thumbnail_bytes,
+        }
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"Janitor error: {e}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def record(self, category: str, files: int, size: int):
+        self.removed_files[category] += files
+        self.removed_bytes[category] += size
+
+    def run_once(self):
+        started = time.monotonic()
+        self.clean_previews()
+        self.clean_thumbnails()
+        self.clean_segments()
+        self.clean_passlogs()
+        self.clean_uploads()
+        self.runs += 1
+        self.last_run = time.time()
+        self.last_duration = time.monotonic() - started
+
+    def clean_previews(self):
+        # 同一预览的视频、帧图片和统计 json 共用前缀 preview_{路径hash}_{参数hash}，整组淘汰
+        groups: Dict[str, List] = {}
+        for entry in os.scandir(PREVIEW_DIR):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            group = groups.setdefault(entry.name[:73], [0.0, 0, []])
+            group[0] = max(group[0], st.st_mtime)
+            group[1] += st.st_size
+            group[2].append(entry.path)
+        files, size, self.preview_bytes = evict_lru(
+            [tuple(g) for g in groups.values()],
+            PREVIEW_CACHE_MB * 1024 * 1024,
+            PREVIEW_MAX_AGE_HOURS * 3600,
+        )
+        self.record("previews", files, size)
+
+    def clean_thumbnails(self):
+        files, size, self.thumbnail_bytes = THUMBNAILS.prune(THUMBNAIL_MAX_AGE_DAYS * 86400)
+        self.record("thumbnails", files, size)
+
+    def clean_segments(self):
+        if not SEGMENT_DIR.exists():
+            return
+        running = {job.id for job in JOB_STORE.active_jobs("running")}
+        cutoff = time.time() - SEGMENT_MAX_AGE_SECONDS
+        for entry in os.scandir(SEGMENT_DIR):
+            if entry.name in running or entry.stat().st_mtime >= cutoff:
+                continue
+            path = Path(entry.path)
+            size = sum(f.stat().st_size for f in path.rglob("*") if f.is_file()) if entry.is_dir() else entry.stat().st_size
+            files = sum(1 for f in path.rglob("*") if f.is_file()) if entry.is_dir() else 1
+            try:
+                if entry.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+                self.record("segments", files, size)
+            except OSError:
+                pass
+
+    def clean_passlogs(self):
+        """两遍编码的第一遍日志按前缀整组淘汰；复用时会刷新 .done 的修改时间"""
+        if not PASSLOG_DIR.exists():
+            return
+        groups: Dict[str, List] = {}
+        for entry in os.scandir(PASSLOG_DIR):
+            if not entry.is_file():
+                continue
+            st = entry.stat()
+            group = groups.setdefault(entry.name[:24], [0.0, 0, []])
+            group[0] = max(group[0], st.st_mtime)
+            group[1] += st.st_size
+            group[2].append(entry.path)
+        files, size, _ = evict_lru([tuple(g) for g in groups.values()], None, PASSLOG_MAX_AGE_DAYS * 86400)
+        self.record("passlogs", files, size)
+
+    def clean_uploads(self):
+        """删除长时间没有新数据的未完成上传"""
+        if not UPLOAD_DIR.exists():
+            return
+        cutoff = time.time() - UPLOAD_MAX_AGE_HOURS * 3600
+        for meta in UPLOAD_DIR.glob("*.json"):
+            upload_id = meta.stem
+            part = UPLOAD_DIR / f"{upload_id}.part"
+            try:
+                mtime = max(meta.stat().st_mtime, part.stat().st_mtime if part.exists() else 0)
+            except OSError:
+                continue
+            if mtime >= cutoff:
+                continue
+            with UPLOAD_SESSIONS_LOCK:
+                UPLOAD_SESSIONS.pop(upload_id, None)
+            size = part.stat().st_size if part.exists() else 0
+            part.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            self.record("uploads", 2, size)
+
+JANITOR = Janitor(JANITOR_INTERVAL)
+
+@app.get("/janitor")
+def get_janitor_stats(current_user: User = Depends(get_current_user)):
+    return JANITOR.stats()
+
+@app.post("/janitor/run")
+def run_janitor(current_user: User = Depends(get_current_user)):
+    """立即执行一次清理"""
+    JANITOR.trigger()
+    return {"message": "清理已触发"}
+
+# --- Prometheus ---
+
+# /metrics 需要 Authorization: Bearer <METRICS_TOKEN> 或已登录用户的令牌；Prometheus 抓取时配置前者
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_PREFIX = "video_transfer_"
+
+def _label_value(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsWriter:
+    """按 Prometheus 文本格式 (0.0.4) 输出指标"""
+
+    def __init__(self):
+        self.lines: List[str] = []
+
+    def _header(self, name: str, kind: str, help_text: str):
+        self.lines.append(f"# HELP {METRICS_PREFIX}{name} {help_text}")
+        self.lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+
+    def metric(self, name: str, kind: str, help_text: str, samples, label_names: Tuple[str, ...] = ()):
+        """samples 为 [(标签值元组, 数值)]，无标签时可直接传数值"""
+        if not isinstance(samples, list):
+            samples = [((), samples)]
+        self._header(name, kind, help_text)
+        for values, value in samples:
+            self.lines.append(f"{METRICS_PREFIX}{name}{_labels(label_names, values)} {_format_value(value)}")
+
+    def histogram(self, name: str, help_text: str, hist: Histogram, label_names: Tuple[str, ...] = ()):
+        self._header(name, "histogram", help_text)
+        bounds = [_format_value(float(b)) for b in hist.buckets] + ["+Inf"]
+        for values, counts, total in hist.samples():
+            for bound, count in zip(bounds, counts):
+                le = 'le="%s"' % bound
+                self.lines.append(f"{METRICS_PREFIX}{name}_bucket{_labels(label_names, values, le)} {count}")
+            self.lines.append(f"{METRICS_PREFIX}{name}_sum{_labels(label_names, values)} {_format_value(float(total))}")
+            self.lines.append(f"{METRICS_PREFIX}{name}_count{_labels(label_names, values)} {counts[-1]}")
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+def render_metrics() -> str:
+    """汇总当前指标；都取自内存中的计数器，唯一的数据库访问是按状态计数"""
+    w = MetricsWriter()
+
+    counts = {s: 0 for s in ("preparing", "pending", "running", "completed", "failed", "cancelled")}
+    counts.update(JOB_STORE.count_by_status())
+    # 未结束的任务以内存中的状态为准 (进度更新不落盘，但状态变化会)
+    active = JOB_STORE.active_jobs()
+    for s in ACTIVE_STATUSES:
+        counts[s] = sum(1 for j in active if j.status == s)
+    w.metric("jobs", "gauge", "Jobs by status.", [((s,), n) for s, n in sorted(counts.items())], ("status",))
+
+    w.metric("scheduler_running_jobs", "gauge", "Jobs currently holding a scheduler slot.", SCHEDULER.running_count)
+    w.metric("scheduler_slots", "gauge", "Maximum number of concurrent jobs.", MAX_CONCURRENT_JOBS)
+    w.metric("scheduler_queued_jobs", "gauge", "Jobs waiting in the scheduler queue.", SCHEDULER.pending_count)
+    w.metric("scheduler_cores_used", "gauge", "Estimated CPU cores reserved by running jobs.", SCHEDULER.used_cores)
+    w.metric("scheduler_cores_budget", "gauge", "CPU core budget for running jobs.", CPU_BUDGET)
+    w.metric("scheduler_memory_used_megabytes", "gauge", "Estimated memory reserved by running jobs.", SCHEDULER.used_memory_mb)
+    w.metric("scheduler_memory_budget_megabytes", "gauge", "Memory budget for running jobs.", MEMORY_BUDGET_MB)
+
+    running = [j for j in active if j.status == "running"]
+    w.metric("job_fps", "gauge", "Encoding frames per second of running jobs.",
+             [((j.id,), j.fps) for j in running if j.fps is not None], ("job",))
+    w.metric("job_speed", "gauge", "Encoding speed (x realtime) of running jobs.",
+             [((j.id,), j.speed) for j in running if j.speed is not None], ("job",))
+    w.metric("job_progress_percent", "gauge", "Progress of running jobs.", [((j.id,), j.progress) for j in running], ("job",))
+    w.metric("batches_active", "gauge", "Batches with unfinished jobs.",
+             BATCHES.active_count())
+
+    w.histogram("job_wall_seconds", "Wall time of jobs from start to finish.", JOB_WALL_SECONDS, ("status",))
+    w.histogram("ffprobe_seconds", "ffprobe latency on probe cache misses.", FFPROBE_SECONDS)
+    w.histogram("preview_seconds", "Preview and size estimate generation time.", PREVIEW_SECONDS, ("task",))
+    w.histogram("thumbnail_seconds", "Thumbnail generation time.", THUMBNAIL_SECONDS)
+    w.histogram("http_request_seconds", "HTTP request latency by route.", HTTP_REQUEST_SECONDS, ("method", "route"))
+
+    caches = [("probe", PROBE_CACHE.hits, PROBE_CACHE.misses), ("thumbnail", THUMBNAILS.hits, THUMBNAILS.misses)]
+    w.metric("cache_hits_total", "counter", "Cache hits.", [((c,), h) for c, h, _ in caches], ("cache",))
+    w.metric("cache_misses_total", "counter", "Cache misses.", [((c,), m) for c, _, m in caches], ("cache",))
+    w.metric("cache_hit_ratio", "gauge", "Cache hit ratio since startup.",
+             [((c,), h / (h + m)) for c, h, m in caches if h + m], ("cache",))
+
+    w.metric("job_read_bytes_total", "counter", "Source bytes read by completed jobs.", JOB_BYTES_READ.value)
+    w.metric("job_written_bytes_total", "counter", "Output bytes written by completed jobs.", JOB_BYTES_WRITTEN.value)
+
+    w.metric("preview_queue_running", "gauge", "Preview tasks running.", PREVIEW_QUEUE.running_count)
+    w.metric("preview_queue_waiting", "gauge", "Preview tasks waiting for a slot.", PREVIEW_QUEUE.waiting_count)
+
+    stats = JANITOR.stats()
+    w.metric("janitor_runs_total", "counter", "Janitor runs.", stats["runs"])
+    w.metric("janitor_removed_files_total", "counter", "Files removed by the janitor.",
+             [((c,), n) for c, n in stats["removed_files"].items()], ("category",))
+    w.metric("janitor_removed_bytes_total", "counter", "Bytes removed by the janitor.",
+             [((c,), n) for c, n in stats["removed_bytes"].items()], ("category",))
+    w.metric("cache_size_bytes", "gauge", "Cache size as of the last janitor run.",
+             [(("preview",), stats["preview_bytes"]), (("thumbnail",), stats["thumbnail_bytes"])], ("cache",))
+    return w.render()
+
+@app.get("/metrics")
+def get_metrics(token: str = Depends(oauth2_scheme)):
+    """Prometheus 指标 (text/plain; version=0.0.4)"""
+    if not (METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())):
+        username = decode_token_username(token)
+        user_data = get_cached_users().get(username) if username else None
+        if user_data is None or user_data.get("disabled"):
+            raise HTTPException(status_code=401, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.on_event("startup")
+def resume_pending_jobs():
+    """服务启动后继续调度数据库中恢复的任务"""
+    SCHEDULER.start()
+    SCHEDULER.submit(JOB_STORE.active_jobs("pending"))
+    # 上次关闭时还没准备完的任务重新探测
+    JOB_PREPARER.submit(JOB_STORE.active_jobs("preparing"))
+    JANITOR.start()
+    WATCHER.start()
 
 # 挂载静态文件（确保放在最后，避免覆盖 API 路由）
 # 注意：我们需要先创建 static 目录